@@ -0,0 +1,473 @@
+"""Offline benchmark for RssBot's fetch/diff/filter/deliver pipeline.
+
+Serves thousands of synthetic feeds (and any recorded feeds you point it at) from a local HTTP server, subscribes a
+fake Discord client to them across many channels, and runs several checks of every feed, changing some of the feeds
+between checks, then sends a burst of `add` and `filter add` commands. Reports how long each check took, per-feed
+fetch latency, peak memory, messages sent and command handling time, plus micro-benchmarks of entry identity and
+filtering. Nothing talks to Discord or the internet.
+
+    python benchmark.py --feeds 2000 --channels 500
+    python benchmark.py --json results.json
+    python benchmark.py --baseline results.json  # exits 1 if anything got more than --tolerance slower/bigger
+
+Most synthetic feeds support ETags (so unchanged ones answer 304); some don't, some are Atom, some are slow to respond
+and some are malformed XML. With --websub, a quarter of the RSS feeds advertise a stand-in WebSub hub, which pushes
+their new entries to RssBot before each check. Configuration that RssBot reads from the environment (WORKERS, STREAMING_PARSE,
+FETCH_CONCURRENCY, ...) applies as usual, except that per-host and per-channel rate limits default to off, since
+every feed is on the same host.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import resource
+import secrets
+import socket
+import sys
+import time
+import timeit
+import tracemalloc
+from contextlib import redirect_stdout
+from statistics import median, quantiles
+from typing import Dict, List, Optional, Set, Tuple
+
+os.environ.setdefault("HOST_CONCURRENCY", "1000")
+os.environ.setdefault("HOST_MIN_INTERVAL", "0")
+os.environ.setdefault("CHANNEL_MIN_INTERVAL", "0")
+
+import aiohttp  # noqa: E402
+import feedparser  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import rssbot  # noqa: E402
+
+KINDS = ["slow", "malformed", "atom", "plain"] + ["rss"] * 16 # by feed number mod 20
+
+
+class Fixtures:
+    """The feeds served by the fixture server. Feed n has `sizes[n]` entries, the newest numbered `versions[n]`."""
+
+    def __init__(self, count: int, seed: int, slow_delay: float, recorded: Optional[str]) -> None:
+        self.random = random.Random(seed)
+        self.sizes = self.random.choices((5, 20, 50, 200, 1000), weights=(30, 30, 25, 12, 3), k=count)
+        self.versions = [self.random.randrange(1000, 2000) for _ in range(count)]
+        self.slow_delay = slow_delay
+        self.recorded: Dict[str, bytes] = {}
+        if recorded:
+            for name in sorted(os.listdir(recorded)):
+                with open(os.path.join(recorded, name), "rb") as file:
+                    self.recorded[name] = file.read()
+        self.requests = 0
+        self.not_modified = 0
+        self.changed: List[int] = [] # feeds that published in the last advance()
+        self.base = "" # where the fixture server is
+        self.hub: Optional[str] = None # the stand-in hub's URL, if some feeds are pushed
+
+    def urls(self, base: str) -> List[str]:
+        return [f"{base}/feed/{n}" for n in range(len(self.sizes))] + [f"{base}/recorded/{name}" for name in self.recorded]
+
+    def advance(self, fraction: float) -> int:
+        """Publish 1-3 new entries in `fraction` of the feeds, returning how many were published."""
+
+        published = 0
+        self.changed = self.random.sample(range(len(self.sizes)), round(len(self.sizes) * fraction))
+        for n in self.changed:
+            new = self.random.randint(1, 3)
+            self.versions[n] += new
+            published += new
+        return published
+
+    def pushed(self, n: int) -> bool:
+        return self.hub is not None and KINDS[n % len(KINDS)] == "rss" and n % 4 == 0
+
+    def body(self, n: int) -> bytes:
+        kind = KINDS[n % len(KINDS)]
+        entries = range(self.versions[n], self.versions[n] - self.sizes[n], -1)
+        summary = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4
+        if kind == "atom":
+            items = "".join(f"<entry><id>urn:bench:{n}:{i}</id><title>Post {i} of feed {n}</title><link href='https://example.com/{n}/{i}'/><updated>2024-01-01T00:00:00Z</updated><summary>{summary}</summary></entry>" for i in entries)
+            return f"<?xml version='1.0' encoding='utf-8'?><feed xmlns='http://www.w3.org/2005/Atom'><title>Feed {n}</title>{items}</feed>".encode()
+        title = f"Ad: sponsored post {{}} of feed {n}" if n % 7 == 0 else f"Post {{}} of feed {n}"
+        items = "".join(f"<item><guid>https://example.com/{n}/{i}</guid><title>{title.format(i)}</title><link>https://example.com/{n}/{i}</link><description>{summary}</description></item>" for i in entries)
+        hub = f"<atom:link rel='hub' href='{self.hub}'/><atom:link rel='self' href='{self.base}/feed/{n}'/>" if self.pushed(n) else ""
+        body = f"<?xml version='1.0' encoding='utf-8'?><rss version='2.0' xmlns:atom='http://www.w3.org/2005/Atom'><channel><title>Feed {n}</title><ttl>5</ttl>{hub}{items}</channel></rss>".encode()
+        if kind == "malformed":
+            return body[:len(body) * 2 // 3]
+        return body
+
+    async def serve_feed(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        n = int(request.match_info["n"])
+        if not 0 <= n < len(self.sizes):
+            raise web.HTTPNotFound()
+        kind = KINDS[n % len(KINDS)]
+        if kind == "slow":
+            await asyncio.sleep(self.slow_delay)
+        etag = f'"{n}-{self.versions[n]}"'
+        if kind != "plain" and request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        headers = {"ETag": etag} if kind != "plain" else {}
+        content_type = "application/atom+xml" if kind == "atom" else "application/rss+xml"
+        return web.Response(body=self.body(n), content_type=content_type, headers=headers)
+
+    async def serve_recorded(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        name = request.match_info["name"]
+        if name not in self.recorded:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.recorded[name], content_type="application/xml")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/feed/{n}", self.serve_feed)
+        app.router.add_get("/recorded/{name}", self.serve_recorded)
+        return app
+
+
+class Hub:
+    """A stand-in WebSub hub: it verifies (un)subscription requests with the subscriber's callback, as a real hub
+    would, and pushes content to subscribers when told to publish it."""
+
+    def __init__(self) -> None:
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.subscriptions: Dict[str, Tuple[str, str]] = {} # { topic -> (callback, secret) }
+        self.verifications: Set[asyncio.Task] = set()
+
+    async def subscribe(self, request: web.Request) -> web.Response:
+        form = dict(await request.post())
+        task = asyncio.create_task(self.verify(form))
+        self.verifications.add(task)
+        task.add_done_callback(self.verifications.discard)
+        return web.Response(status=202)
+
+    async def verify(self, form: Dict[str, str]) -> None:
+        challenge = secrets.token_hex(8)
+        query = {"hub.mode": form["hub.mode"], "hub.topic": form["hub.topic"], "hub.challenge": challenge, "hub.lease_seconds": form.get("hub.lease_seconds", "86400")}
+        async with self.session.get(form["hub.callback"], params=query) as response:
+            if response.status != 200 or await response.text() != challenge:
+                return
+        if form["hub.mode"] == "subscribe":
+            self.subscriptions[form["hub.topic"]] = (form["hub.callback"], form["hub.secret"])
+        else:
+            self.subscriptions.pop(form["hub.topic"], None)
+
+    async def settle(self) -> None:
+        """Wait for verifications in progress."""
+
+        while self.verifications:
+            await asyncio.gather(*list(self.verifications))
+
+    async def publish(self, topic: str, body: bytes) -> Optional[float]:
+        """Push content to the topic's subscriber, returning how long it took to accept it (None if nobody's subscribed)."""
+
+        if topic not in self.subscriptions:
+            return None
+        callback, secret = self.subscriptions[topic]
+        headers = {"Content-Type": "application/rss+xml", "X-Hub-Signature": "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()}
+        start = time.perf_counter()
+        async with self.session.post(callback, data=body, headers=headers) as response:
+            await response.read()
+        return time.perf_counter() - start
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/hub", self.subscribe)
+        return app
+
+
+class FakeChannel:
+    def __init__(self, sink: "BenchBot", id: int) -> None:
+        self.sink = sink
+        self.id = id
+        self.name = f"channel-{id}"
+
+    async def send(self, content=None, embeds=(), **kwargs) -> None:
+        self.sink.messages += 1
+        self.sink.characters += len(content or "") + sum(len(embed) for embed in embeds)
+
+
+class FakeMessage:
+    """A command sent to RssBot (see BenchBot.command_burst)."""
+
+    def __init__(self, channel: FakeChannel) -> None:
+        self.channel = channel
+        self.author = FakeUser()
+
+    async def reply(self, content=None, **kwargs) -> None:
+        self.channel.sink.replies += 1
+
+
+class FakeUser:
+    id = 0
+
+    def __str__(self) -> str:
+        return "benchmark"
+
+
+class BenchBot(rssbot.RssBot):
+    """An RssBot whose Discord client is a sink that counts what would have been sent."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.messages = 0
+        self.characters = 0
+        self.notifications = 0
+        self.replies = 0
+
+    def get_channel(self, id: int) -> FakeChannel:
+        return FakeChannel(self, id)
+
+    async def notify(self, msg: str) -> None:
+        self.notifications += 1
+
+    async def change_presence(self, **kwargs) -> None:
+        pass
+
+    async def drain(self) -> None:
+        """Wait until everything queued for delivery has been sent."""
+
+        while self.delivery.workers:
+            await asyncio.gather(*list(self.delivery.workers.values()))
+
+    async def command_burst(self, urls: List[str], channels: int, rng: random.Random) -> List[float]:
+        """Send an `add` and then a `filter add` for each feed, all at once, from the channels that don't have it.
+
+        Returns how long each command took to handle.
+        """
+
+        async def run(message: FakeMessage, text: str) -> float:
+            start = time.perf_counter()
+            await self.run_command(message, text)
+            return time.perf_counter() - start
+
+        commands = []
+        for url in urls:
+            channel = rng.choice([c for c in range(1, channels + 1) if c not in self.feeds[url]] or [channels + 1])
+            message = FakeMessage(self.get_channel(channel))
+            commands += [(message, f"add {url}"), (message, f"filter add {url} re:(?i)^sponsored:")]
+        adds = await asyncio.gather(*(run(message, text) for message, text in commands[0::2]))
+        filters = await asyncio.gather(*(run(message, text) for message, text in commands[1::2]))
+        return adds + filters
+
+
+def subscriptions(urls: List[str], channels: int, rng: random.Random) -> Dict[str, Dict[int, List[str]]]:
+    """Subscribe each feed to 1-3 channels; every fifth channel filters out ads (and every third is in digest mode)."""
+
+    feeds: Dict[str, Dict[int, List[str]]] = {}
+    for url in urls:
+        for channel in rng.sample(range(1, channels + 1), min(channels, rng.randint(1, 3))):
+            feeds.setdefault(url, {})[channel] = ["re:(?i)^ad:", "sponsored"] if channel % 5 == 0 else []
+    return feeds
+
+
+def distribution(values: List[float]) -> Dict[str, float]:
+    if len(values) < 2:
+        return {"p50": values[0] if values else 0.0, "p95": values[0] if values else 0.0, "max": values[0] if values else 0.0}
+    return {"p50": median(values), "p95": quantiles(values, n=20)[-1], "max": max(values)}
+
+
+async def run_checks(args: argparse.Namespace) -> Dict:
+    fixtures = Fixtures(args.feeds, args.seed, args.slow_delay, args.recorded)
+    runner = web.AppRunner(fixtures.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    port = runner.addresses[0][1]
+    fixtures.base = f"http://127.0.0.1:{port}"
+    urls = fixtures.urls(fixtures.base)
+
+    hub = Hub()
+    if args.websub:
+        hub.session = aiohttp.ClientSession()
+        hub_runner = web.AppRunner(hub.app(), access_log=None)
+        await hub_runner.setup()
+        await web.TCPSite(hub_runner, "127.0.0.1", 0).start()
+        fixtures.hub = f"http://127.0.0.1:{hub_runner.addresses[0][1]}/hub"
+        # RssBot reads these from the environment at import; its listener needs a free port
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            rssbot.HTTP_PORT = sock.getsockname()[1]
+        rssbot.HTTP_HOST = "127.0.0.1"
+        rssbot.WEBSUB_URL = f"http://127.0.0.1:{rssbot.HTTP_PORT}"
+
+    feeds = subscriptions(urls, args.channels, random.Random(args.seed))
+    bot = BenchBot(feeds, {}, ["unsubscribe"], rssbot.StateStore(":memory:"))
+    bot.channel_modes = {channel: "digest" for channel in bot.channels if channel % 3 == 0}
+    await bot.setup_hook()
+
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    if args.tracemalloc:
+        tracemalloc.start()
+    rounds = []
+    for number in range(args.rounds):
+        published = fixtures.advance(args.change) if number else 0
+        pushes = []
+        if args.websub and number:
+            messages = bot.messages
+            with redirect_stdout(output):
+                for n in fixtures.changed:
+                    pushes.append(await hub.publish(f"{fixtures.base}/feed/{n}", fixtures.body(n)))
+                await bot.drain()
+            pushes = [seconds for seconds in pushes if seconds is not None]
+            push_messages = bot.messages - messages
+        requests, not_modified, messages = fixtures.requests, fixtures.not_modified, bot.messages
+        start = time.perf_counter()
+        with redirect_stdout(output):
+            await bot.check_feeds(list(bot.feeds))
+        checked = time.perf_counter()
+        await bot.drain()
+        delivered = time.perf_counter()
+        if args.websub:
+            await asyncio.gather(*list(bot.tasks))
+            await hub.settle()
+        bot.save_feed_state(list(bot.feeds))
+        await bot.writer.flush()
+        saved = time.perf_counter()
+        rounds.append({
+            "round": number,
+            "published": published,
+            "check_seconds": checked - start,
+            "deliver_seconds": delivered - checked,
+            "save_seconds": saved - delivered,
+            "requests": fixtures.requests - requests,
+            "not_modified": fixtures.not_modified - not_modified,
+            "messages": bot.messages - messages,
+            "loaded": len(bot.feed_data.loaded),
+            "latency": distribution([bot.metrics.feeds[url].latency for url in urls if url in bot.metrics.feeds]),
+            "parse": distribution([bot.metrics.feeds[url].parse_time for url in urls if url in bot.metrics.feeds]),
+        })
+        if args.websub:
+            rounds[-1]["websub"] = {"subscribed": len(hub.subscriptions), "pushes": len(pushes), "push_messages": push_messages if pushes else 0, "push_seconds": distribution(pushes)}
+        print(f"round {number}: {rounds[-1]['check_seconds']:.2f}s check, {rounds[-1]['messages']} messages", file=sys.stderr)
+    with redirect_stdout(output):
+        commands = await bot.command_burst(random.Random(args.seed).sample(urls, min(len(urls), args.commands // 2)), args.channels, random.Random(args.seed))
+        start = time.perf_counter()
+        await bot.writer.flush()
+        command_save = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    tracemalloc.stop()
+
+    result = {
+        "feeds": len(urls),
+        "channels": len(bot.channels),
+        "subscriptions": sum(len(channels) for channels in feeds.values()),
+        "rounds": rounds,
+        "peak_traced_bytes": peak,
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "messages": bot.messages,
+        "characters": bot.characters,
+        "notifications": bot.notifications,
+        "commands": {"count": len(commands), "replies": bot.replies, "seconds": distribution(commands), "save_seconds": command_save},
+    }
+    await bot.close()
+    await runner.cleanup()
+    if args.websub:
+        await hub.session.close()
+        await hub_runner.cleanup()
+    if output is not sys.stdout:
+        output.close()
+    return result
+
+
+def micro_benchmarks(seed: int) -> Dict[str, float]:
+    """Seconds per entry of the hot per-entry operations, on a 1000-entry feed."""
+
+    fixtures = Fixtures(8, seed, 0, None)
+    fixtures.sizes[7] = 1000
+    parsed = feedparser.parse(fixtures.body(7)).entries # feed 7 is RSS with ads in it
+    entries = [rssbot.Entry(entry) for entry in parsed]
+    stored = [rssbot.Entry.from_dict(entry.to_dict()) for entry in entries]
+    filters = ["re:(?i)^ad:", "sponsored", "re:\\bcrypto\\b"]
+    channels = {channel: filters[:channel % 3] for channel in range(300)} # a popular feed: 300 channels, 3 distinct filter lists
+    results = {}
+    for name, statement in (
+        ("entry_init", lambda: [rssbot.Entry(entry) for entry in parsed]),
+        ("entry_key", lambda: [rssbot.Entry(entry).key() for entry in parsed]),
+        ("entry_eq", lambda: [a == b for a, b in zip(entries, stored)]),
+        ("censored_by", lambda: [rssbot.censored_by(entry, filters) for entry in entries]),
+        ("add_details", lambda: [rssbot.Entry(entry).add_details(entry) for entry in parsed]),
+        ("plan_deliveries", lambda: rssbot.plan_deliveries("https://example.com/feed", entries, channels)),
+    ):
+        loops, total = timeit.Timer(statement).autorange()
+        results[name] = total / loops / len(parsed)
+    return results
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """The measurements that are more than `tolerance` worse than the baseline's."""
+
+    def measurements(r):
+        last = r["rounds"][-1]
+        m = {"first check seconds": r["rounds"][0]["check_seconds"], "last check seconds": last["check_seconds"], "p95 latency": last["latency"]["p95"]}
+        if "commands" in r:
+            m["p95 command seconds"] = r["commands"]["seconds"]["p95"]
+        if r["peak_traced_bytes"]:
+            m["peak traced bytes"] = r["peak_traced_bytes"]
+        m.update({f"{name} per entry": seconds for name, seconds in r["micro"].items()})
+        return m
+    base = measurements(baseline)
+    return [f"{name}: {value:.4g} vs {base[name]:.4g}" for name, value in measurements(result).items() if name in base and value > base[name] * (1 + tolerance)]
+
+
+def report(result: Dict) -> str:
+    lines = [f"{result['feeds']} feeds, {result['channels']} channels, {result['subscriptions']} subscriptions"]
+    for r in result["rounds"]:
+        lines.append(f"round {r['round']}: {r['published']} new entries published; check {r['check_seconds']:.2f}s, deliver {r['deliver_seconds']:.2f}s, save {r['save_seconds']:.2f}s; "
+                     f"{r['requests']} requests ({r['not_modified']} not modified), {r['messages']} messages; "
+                     f"fetch latency p50 {r['latency']['p50'] * 1000:.1f}ms p95 {r['latency']['p95'] * 1000:.1f}ms max {r['latency']['max'] * 1000:.1f}ms; "
+                     f"parse p95 {r['parse']['p95'] * 1000:.1f}ms; {r.get('loaded', result['feeds'])} feeds' state in memory")
+        if "websub" in r:
+            w = r["websub"]
+            lines.append(f"  websub: {w['subscribed']} feeds subscribed; before the check, {w['pushes']} pushes sent {w['push_messages']} messages, push handling p50 {w['push_seconds']['p50'] * 1000:.1f}ms p95 {w['push_seconds']['p95'] * 1000:.1f}ms")
+    if result["peak_traced_bytes"] is not None:
+        lines.append(f"peak traced memory: {result['peak_traced_bytes'] / 2 ** 20:.1f} MiB")
+    lines.append(f"max RSS: {result['max_rss_kib'] / 1024:.1f} MiB")
+    lines.append(f"messages sent: {result['messages']} ({result['characters']} characters), notifications: {result['notifications']}")
+    c = result["commands"]
+    lines.append(f"commands: {c['count']} ({c['replies']} replies), handling p50 {c['seconds']['p50'] * 1000:.2f}ms p95 {c['seconds']['p95'] * 1000:.2f}ms max {c['seconds']['max'] * 1000:.2f}ms; "
+                 f"saved afterwards in {c['save_seconds'] * 1000:.1f}ms")
+    lines.append("per entry: " + ", ".join(f"{name} {seconds * 1e6:.2f}us" for name, seconds in result["micro"].items()))
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--feeds", type=int, default=2000, help="synthetic feeds to serve")
+    parser.add_argument("--channels", type=int, default=500, help="channels to spread subscriptions across")
+    parser.add_argument("--rounds", type=int, default=3, help="checks of every feed (the first one primes them)")
+    parser.add_argument("--change", type=float, default=0.1, help="fraction of feeds that publish between checks")
+    parser.add_argument("--slow-delay", type=float, default=2.0, help="seconds the slow feeds take to respond")
+    parser.add_argument("--recorded", help="directory of recorded feed files to serve as well")
+    parser.add_argument("--commands", type=int, default=200, help="add and filter add commands to send in a burst at the end")
+    parser.add_argument("--websub", action="store_true", help="push some feeds' new entries from a stand-in WebSub hub")
+    parser.add_argument("--port", type=int, default=0, help="port for the fixture server (default: any free port)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracemalloc", action="store_true", help="trace allocations to report peak Python memory (several times slower)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--baseline", help="compare against results written by --json, failing on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown/growth relative to the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show RssBot's own output")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_checks(args))
+    result["micro"] = micro_benchmarks(args.seed)
+    print(report(result))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=4)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 (writers.writePython3Bin "rssbot" {
   libraries = with python3Packages; [
     (discordpy.override { withVoice = false; })
+    aiohttp
     feedparser
     validators
   ];
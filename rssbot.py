@@ -1,33 +1,189 @@
 import json
 import os
+import re
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+import bisect
+import calendar
+import html
+import io
 import hashlib
-from asyncio import sleep, create_task
+import heapq
+import hmac
+import multiprocessing
+import secrets
+import sqlite3
+import threading
+import time
+import warnings
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict
+from asyncio import sleep, create_task, gather, get_running_loop, run, Semaphore, Lock, Queue, Task, Future, Event, wait_for
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from os import environ
-from random import randrange
-from typing import List, Optional, Dict
+from statistics import median
+from typing import List, Optional, Dict, NamedTuple, Tuple, Pattern, Set, MutableMapping, Iterator, Callable, Awaitable
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from xml.etree import ElementTree
 
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
 import discord.utils
 import feedparser
 import validators
-from discord import Client, Intents, Message, Status, ActivityType, Activity, DMChannel, GroupChannel
+from discord import Client, Intents, Message, Status, ActivityType, Activity, DMChannel, GroupChannel, HTTPException, File, Embed
 
 RSS_FETCH_INTERVAL = 5 * 60 # 5 minutes
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', 32)) # feeds downloaded at once
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 4)) # threads running feedparser
+MIN_FETCH_INTERVAL = float(os.getenv('MIN_FETCH_INTERVAL', 2 * 60)) # never poll a feed more often than this
+MAX_FETCH_INTERVAL = float(os.getenv('MAX_FETCH_INTERVAL', 6 * 60 * 60)) # never poll a feed less often than this
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', 30)) # seconds a single feed request may take, start to finish
+FAILURES_TO_REPORT = 3 # consecutive failures before a feed is reported as failing
+CIRCUIT_THRESHOLD = int(os.getenv('CIRCUIT_THRESHOLD', 10)) # consecutive failures after which a feed is only retried daily
+CIRCUIT_RETRY_INTERVAL = 24 * 60 * 60
+SEEN_INDEX_SIZE = int(os.getenv('SEEN_INDEX_SIZE', 500)) # entries remembered per feed (at least the whole feed)
+STREAMING_PARSE = "STREAMING_PARSE" in environ # parse feeds as they download, stopping at the first seen entry
+STREAM_CHUNK_SIZE = 64 * 1024
+MESSAGE_LIMIT = 2000 # characters in a Discord message
+STATUS_FEEDS = 5 # feeds (and channels) listed by `status` in each section
+EMBED_LIMIT = 6000 # characters across all the embeds in a Discord message
+EMBEDS_PER_MESSAGE = 10
+EXCERPT_LENGTH = int(os.getenv('EXCERPT_LENGTH', 300)) # characters of each entry's summary shown in digest mode
+CHANNEL_MIN_INTERVAL = float(os.getenv('CHANNEL_MIN_INTERVAL', 1.0)) # seconds between messages to one channel
+WORKERS = int(os.getenv('WORKERS', 0)) # processes fetching and parsing feeds (0 does it all in this process)
+SHARD_TIMEOUT = float(os.getenv('SHARD_TIMEOUT', 10 * 60)) # seconds a worker process may take to check a group of feeds
+HOST_CONCURRENCY = int(os.getenv('HOST_CONCURRENCY', 2)) # requests in flight to any one host
+HOST_MIN_INTERVAL = float(os.getenv('HOST_MIN_INTERVAL', 1.0)) # seconds between requests to one host
+USER_AGENT = "rssbot (+https://github.com/Samasaur1/rssbot)"
+HTTP_HOST = os.getenv('HTTP_HOST', '127.0.0.1') # where the local HTTP listener (/metrics) binds
+HTTP_PORT = int(os.getenv('HTTP_PORT', 0)) # 0 disables the local HTTP listener
+METRICS_FILE = os.getenv('METRICS_FILE') # if set, metrics are also written here after every check
+WEBSUB_URL = os.getenv('WEBSUB_URL', '').rstrip('/') # public URL of the HTTP listener; setting it enables WebSub
+WEBSUB_LEASE = int(os.getenv('WEBSUB_LEASE', 10 * 24 * 60 * 60)) # seconds of push subscription to ask hubs for
+WEBSUB_POLL_INTERVAL = float(os.getenv('WEBSUB_POLL_INTERVAL', 6 * 60 * 60)) # fallback polling of feeds that push
+FEED_CACHE_SIZE = int(os.getenv('FEED_CACHE_SIZE', 0)) # feeds whose state is kept in memory (0 keeps every feed's)
+SAVE_DELAY = float(os.getenv('SAVE_DELAY', 1.0)) # seconds changes to state are collected for before they're written
+VERBOSE = "VERBOSE" in environ
 
 def verbose(*args) -> None:
     """Print the specified args only if $VERBOSE is set."""
 
-    if "VERBOSE" in environ.keys():
+    if VERBOSE:
         print("verbose:", *args)
 
 
+MEDIA_NS = "http://search.yahoo.com/mrss/"
+DC_NS = "http://purl.org/dc/elements/1.1/"
+
+def excerpt(text: Optional[str], length: int = EXCERPT_LENGTH) -> Optional[str]:
+    """Plain text from the start of an HTML summary, cut at a word boundary to at most `length` characters."""
+
+    if not text:
+        return None
+    # Only the start of the summary can end up in the excerpt, however much markup there is
+    text = re.sub(r"<[^>]*>?", " ", text[:length * 8])
+    text = " ".join(html.unescape(text).split())
+    if len(text) > length:
+        text = text[:length - 1].rsplit(" ", 1)[0].rstrip(",.;:") + "…"
+    return text or None
+
+def thumbnail(entry) -> Optional[str]:
+    """The URL of the entry's image, from Media RSS or an image enclosure."""
+
+    candidates = list(entry.get("media_thumbnail") or [])
+    candidates += [m for m in entry.get("media_content") or [] if m.get("medium") == "image" or (m.get("type") or "").startswith("image/")]
+    candidates += [e for e in entry.get("enclosures") or [] if (e.get("type") or "").startswith("image/")]
+    for candidate in candidates:
+        url = candidate.get("url") or candidate.get("href")
+        if url and url.startswith(("http://", "https://")):
+            return url
+    return None
+
+
 class Entry:
+    """The parts of a feed entry that we post or identify it by.
+
+    The summary and content are only kept (until they're hashed) if identifying the entry needs them, i.e. it has no
+    id, link or title. What digest mode shows (a plain-text excerpt, the author, the date and a thumbnail) is only
+    extracted for new entries (see add_details), and each entry's embed is rendered once however many channels it
+    goes to.
+    """
+
+    __slots__ = ("id", "link", "title", "_summary", "_content", "_summary_hash", "_content_hash", "_key", "_output", "excerpt", "author", "published", "thumbnail", "_embed")
+
+    @classmethod
+    def from_dict(cls, d):
+        self = cls(d)
+        self._summary_hash = d.get("summary_hash", None)
+        self._content_hash = d.get("content_hash", None)
+        return self
+
     def __init__(self, entry):
         self.id = entry.get("id", None)
         self.link = entry.get("link", None)
         self.title = entry.get("title", None)
-        self.summary_hash = hashlib.md5(entry["summary"].encode()).hexdigest() if "summary" in entry else None
-        self.content_hash = hashlib.md5(entry["content"][0].value.encode()).hexdigest() if "content" in entry else None
+        if self.id or self.link or self.title:
+            # The entry is identified without them (see key), so don't carry whole articles around
+            self._summary: Optional[str] = None
+            self._content: Optional[str] = None
+        else:
+            self._summary = entry.get("summary", None)
+            self._content = entry["content"][0].value if entry.get("content") else None
+        self._summary_hash: Optional[str] = None
+        self._content_hash: Optional[str] = None
+        self._key: Optional[str] = None
+        self._output: Optional[str] = None
+        self.excerpt: Optional[str] = None
+        self.author: Optional[str] = None
+        self.published: Optional[float] = None
+        self.thumbnail: Optional[str] = None
+        self._embed: Optional[Embed] = None
+
+    def add_details(self, entry) -> None:
+        """Extract what digest mode shows from the parsed entry this was made from."""
+
+        self.excerpt = excerpt(entry.get("summary") or (entry["content"][0].value if entry.get("content") else None))
+        self.author = entry.get("author", None)
+        published = entry.get("published_parsed") or entry.get("updated_parsed")
+        self.published = calendar.timegm(published) if published else None
+        self.thumbnail = thumbnail(entry)
+
+    @property
+    def summary_hash(self) -> Optional[str]:
+        if self._summary is not None:
+            self._summary_hash = hashlib.md5(self._summary.encode()).hexdigest()
+            self._summary = None
+        return self._summary_hash
+
+    @property
+    def content_hash(self) -> Optional[str]:
+        if self._content is not None:
+            self._content_hash = hashlib.md5(self._content.encode()).hexdigest()
+            self._content = None
+        return self._content_hash
+
+    def to_dict(self):
+        return {"id": self.id, "link": self.link, "title": self.title, "summary_hash": self.summary_hash, "content_hash": self.content_hash}
+
+    def key(self) -> str:
+        """A short hash identifying this entry, from the first of id, link, title, summary hash and content hash it has."""
+
+        if self._key is None:
+            if self.id:
+                kind, value = "i", self.id
+            elif self.link:
+                kind, value = "l", self.link
+            elif self.title:
+                kind, value = "t", self.title
+            elif self.summary_hash:
+                kind, value = "s", self.summary_hash
+            else:
+                kind, value = "c", self.content_hash or ""
+            self._key = hashlib.blake2b(f"{kind}:{value}".encode(), digest_size=8).hexdigest()
+        return self._key
 
     def __eq__(self, other):
         verbose("in __eq__")
@@ -48,115 +204,873 @@ class Entry:
         verbose(f"match by c_h: {self.content_hash == other.content_hash}")
         return self.content_hash == other.content_hash
 
-    def output(self):
-        if self.title and self.link:
-            return f"{self.title} ({self.link})"
-        elif self.link:
-            return self.link
-        return "a post"
+    def output(self) -> str:
+        if self._output is None:
+            if self.title and self.link:
+                self._output = f"{self.title} ({self.link})"
+            elif self.link:
+                self._output = self.link
+            else:
+                self._output = "a post"
+        return self._output
+
+    def embed(self, feed: str) -> Embed:
+        if self._embed is None:
+            title = self.title or self.link or "a post"
+            embed = Embed(title=title if len(title) <= 256 else title[:255] + "…", description=self.excerpt)
+            if self.link and self.link.startswith(("http://", "https://")):
+                embed.url = self.link
+            if self.published:
+                embed.timestamp = datetime.fromtimestamp(self.published, timezone.utc)
+            if self.author:
+                embed.set_author(name=self.author[:256])
+            if self.thumbnail:
+                embed.set_thumbnail(url=self.thumbnail)
+            embed.set_footer(text=feed[:2048])
+            self._embed = embed
+        return self._embed
+
+
+def retry_after(value: Optional[str]) -> float:
+    """Parse a Retry-After header (seconds or an HTTP date), defaulting to one fetch interval."""
+
+    if not value:
+        return RSS_FETCH_INTERVAL
+    if value.strip().isdigit():
+        return float(value.strip())
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return RSS_FETCH_INTERVAL
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class FeedStats:
+    """What happened the last time a feed was fetched."""
+
+    __slots__ = ("status", "bytes", "latency", "parse_time", "entries", "fetched_at")
+
+    def __init__(self) -> None:
+        self.status: int = 0 # HTTP status, or 0 if the request failed outright
+        self.bytes: int = 0 # body bytes read (less than the whole body if streaming stopped early)
+        self.latency: float = 0.0 # seconds from sending the request to finishing reading the body
+        self.parse_time: float = 0.0 # seconds spent parsing
+        self.entries: int = 0 # new entries found
+        self.fetched_at: float = 0.0 # UNIX time
+
+
+class CommandStats:
+    """How long a command has taken to handle, over every time it's been run."""
+
+    __slots__ = ("count", "total", "slowest", "errors")
+
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.total: float = 0.0 # seconds
+        self.slowest: float = 0.0 # seconds
+        self.errors: int = 0 # runs that raised an exception
+
+
+def prometheus_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Instrumentation for the update loop, exported in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self.feeds: Dict[str, FeedStats] = {}
+        self.counters: Dict[str, float] = {}
+        self.cycle_duration: float = 0.0
+        self.cycle_feeds: int = 0
+        self.commands: Dict[str, CommandStats] = {}
+
+    def feed(self, url: str) -> FeedStats:
+        if url not in self.feeds:
+            self.feeds[url] = FeedStats()
+        return self.feeds[url]
+
+    def count(self, name: str, amount: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def cycle(self, duration: float, feeds: int) -> None:
+        self.cycle_duration = duration
+        self.cycle_feeds = feeds
+        self.count("rssbot_checks_total")
+        self.count("rssbot_feeds_checked_total", feeds)
+
+    def command(self, name: str, duration: float, failed: bool = False) -> None:
+        if name not in self.commands:
+            self.commands[name] = CommandStats()
+        stats = self.commands[name]
+        stats.count += 1
+        stats.total += duration
+        stats.slowest = max(stats.slowest, duration)
+        stats.errors += failed
+
+    def render(self) -> str:
+        lines = [
+            "# TYPE rssbot_check_duration_seconds gauge",
+            f"rssbot_check_duration_seconds {self.cycle_duration}",
+            "# TYPE rssbot_check_feeds gauge",
+            f"rssbot_check_feeds {self.cycle_feeds}",
+        ]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        for field, name in (("latency", "rssbot_feed_fetch_seconds"), ("parse_time", "rssbot_feed_parse_seconds"), ("bytes", "rssbot_feed_bytes"), ("status", "rssbot_feed_status"), ("entries", "rssbot_feed_new_entries"), ("fetched_at", "rssbot_feed_fetched_timestamp_seconds")):
+            lines.append(f"# TYPE {name} gauge")
+            for url, stats in self.feeds.items():
+                lines.append(f'{name}{{feed="{prometheus_label(url)}"}} {getattr(stats, field)}')
+        lines.append("# TYPE rssbot_command_seconds summary")
+        for command, stats in sorted(self.commands.items()):
+            lines.append(f'rssbot_command_seconds_count{{command="{prometheus_label(command)}"}} {stats.count}')
+            lines.append(f'rssbot_command_seconds_sum{{command="{prometheus_label(command)}"}} {stats.total}')
+        for field, name in (("slowest", "rssbot_command_max_seconds"), ("errors", "rssbot_command_errors")):
+            lines.append(f"# TYPE {name} gauge")
+            for command, stats in sorted(self.commands.items()):
+                lines.append(f'{name}{{command="{prometheus_label(command)}"}} {getattr(stats, field)}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Write the metrics to a file, atomically (so a scraper never sees half of them)."""
+
+        with open(f"{path}.tmp", "w") as file:
+            file.write(self.render())
+        os.replace(f"{path}.tmp", path)
+
+    def summary(self, slowest: int = 5) -> str:
+        feeds = sorted(self.feeds.items(), key=lambda item: item[1].latency + item[1].parse_time, reverse=True)[:slowest]
+        slow = "\n".join(f"- {url}: {stats.latency:.2f}s fetch, {stats.parse_time:.2f}s parse, {stats.bytes} bytes, status {stats.status}" for url, stats in feeds)
+        commands = ", ".join(f"{name} {stats.count}x avg {stats.total / stats.count * 1000:.0f}ms max {stats.slowest * 1000:.0f}ms" for name, stats in sorted(self.commands.items(), key=lambda item: item[1].slowest, reverse=True)[:slowest])
+        return f"""Last check: {self.cycle_feeds} feeds in {self.cycle_duration:.2f}s
+Messages sent: {int(self.counters.get("rssbot_messages_sent_total", 0))} ({int(self.counters.get("rssbot_message_errors_total", 0))} failed)
+Commands: {commands or "none yet"}
+Slowest feeds:
+{slow}"""
+
+
+class FetchResult(NamedTuple):
+    status: int
+    url: str
+    headers: CIMultiDict # header names are case-insensitive, whatever case the server sends them in
+    body: bytes
+
+
+class HostBackedOff(Exception):
+    """Raised instead of waiting for a host that asked us to back off (with a 429 or 503)."""
+
+    def __init__(self, seconds: float) -> None:
+        super().__init__(f"host asked us to back off for {seconds:.0f}s")
+        self.seconds = seconds
+
+
+class Limiter:
+    """Politeness limits for a single host (or channel): a cap on requests in flight and a minimum gap between them.
+
+    A host that has asked us to back off isn't waited for: entering the limiter raises HostBackedOff until it's time.
+    """
+
+    def __init__(self, concurrency: int, min_interval: float) -> None:
+        self.semaphore = Semaphore(concurrency)
+        self.lock = Lock()
+        self.min_interval = min_interval
+        self.next_request = 0.0
+        self.resume = 0.0 # loop time until which the host has asked us to back off
+
+    async def __aenter__(self) -> None:
+        await self.semaphore.acquire()
+        try:
+            async with self.lock:
+                loop = get_running_loop()
+                if self.resume > loop.time():
+                    raise HostBackedOff(self.resume - loop.time())
+                delay = self.next_request - loop.time()
+                if delay > 0:
+                    await sleep(delay)
+                self.next_request = loop.time() + self.min_interval
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    async def __aexit__(self, *exc) -> None:
+        self.semaphore.release()
+
+    def back_off(self, seconds: float) -> None:
+        """Don't send another request for the given number of seconds (e.g. after a 429), up to MAX_FETCH_INTERVAL."""
+
+        self.resume = max(self.resume, get_running_loop().time() + min(seconds, MAX_FETCH_INTERVAL))
+
+
+class Fetcher:
+    """Downloads feeds concurrently over a shared HTTP session and parses them off the event loop.
+
+    The session keeps connections alive and pools them per host, and every host gets its own
+    Limiter so that many feeds on one site don't hammer it.
+    """
+
+    def __init__(self, metrics: Metrics, concurrency: int = FETCH_CONCURRENCY, parse_workers: int = PARSE_WORKERS) -> None:
+        self.metrics = metrics
+        self.semaphore = Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=parse_workers, thread_name_prefix="rssbot.parse")
+        connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=HOST_CONCURRENCY, keepalive_timeout=RSS_FETCH_INTERVAL + 30, ttl_dns_cache=RSS_FETCH_INTERVAL)
+        timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT, sock_connect=min(FETCH_TIMEOUT, 10))
+        self.session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": USER_AGENT}, timeout=timeout)
+        self.hosts: Dict[str, Limiter] = {}
+
+    def host(self, url: str) -> Limiter:
+        hostname = (urlsplit(url).hostname or "").lower()
+        if hostname not in self.hosts:
+            self.hosts[hostname] = Limiter(HOST_CONCURRENCY, HOST_MIN_INTERVAL)
+        return self.hosts[hostname]
+
+    @asynccontextmanager
+    async def open(self, url: str, etag: Optional[str] = None, modified: Optional[str] = None):
+        """Send a (conditional) GET for the feed, yielding the response before its body has been read."""
+
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+        host = self.host(url)
+        stats = self.metrics.feed(url)
+        # The host's limiter first, so feeds waiting on a slow or rate-limited host don't hold up other hosts' feeds
+        async with host, self.semaphore:
+            start = time.perf_counter()
+            stats.status = 0
+            stats.bytes = 0
+            stats.parse_time = 0.0
+            stats.entries = 0
+            stats.fetched_at = time.time()
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    stats.status = response.status
+                    if response.status in (429, 503):
+                        host.back_off(retry_after(response.headers.get("Retry-After")))
+                    yield response
+            except Exception:
+                self.metrics.count("rssbot_fetch_errors_total")
+                raise
+            finally:
+                stats.latency = time.perf_counter() - start
+
+    async def fetch(self, url: str, etag: Optional[str] = None, modified: Optional[str] = None) -> FetchResult:
+        async with self.open(url, etag=etag, modified=modified) as response:
+            body = await response.read()
+            self.metrics.feed(url).bytes = len(body)
+            return FetchResult(response.status, str(response.url), CIMultiDict(response.headers), body)
+
+    async def parse(self, url: str, result: FetchResult):
+        """Run feedparser on a downloaded body in the worker pool."""
+
+        response_headers = {k.lower(): v for k, v in result.headers.items()}
+        response_headers.setdefault("content-location", result.url)
+
+        def parse():
+            start = time.perf_counter()
+            try:
+                return feedparser.parse(result.body, response_headers=response_headers)
+            finally:
+                self.metrics.feed(url).parse_time = time.perf_counter() - start
+        return await get_running_loop().run_in_executor(self.executor, parse)
+
+    async def close(self) -> None:
+        await self.session.close()
+        self.executor.shutdown(wait=False)
+
+
+SY_UPDATE_PERIODS = {
+    "hourly": 60 * 60,
+    "daily": 24 * 60 * 60,
+    "weekly": 7 * 24 * 60 * 60,
+    "monthly": 30 * 24 * 60 * 60,
+    "yearly": 365 * 24 * 60 * 60,
+}
+
+def update_hint(feed) -> Optional[float]:
+    """How often (in seconds) the feed says it should be polled, from <ttl> or sy:updatePeriod/sy:updateFrequency."""
+
+    hints = []
+    try:
+        hints.append(float(feed["ttl"]) * 60)
+    except (KeyError, TypeError, ValueError):
+        pass
+    period = SY_UPDATE_PERIODS.get(str(feed.get("sy_updateperiod", "")).strip().lower())
+    if period:
+        try:
+            frequency = max(1.0, float(feed.get("sy_updatefrequency", 1)))
+        except (TypeError, ValueError):
+            frequency = 1.0
+        hints.append(period / frequency)
+    return max(hints) if hints else None
+
+def websub_links(feed, headers) -> Tuple[Optional[str], Optional[str]]:
+    """The WebSub hub and topic (self) URLs a feed advertises, in Link headers or its own <link>s, if it has a hub."""
+
+    links: Dict[str, str] = {}
+    for value in headers.getall("Link", []):
+        for url, params in re.findall(r"<([^>]*)>([^,]*)", value):
+            for rel in (re.search(r'rel\s*=\s*"?([^";]*)"?', params) or [None, ""])[1].split():
+                links.setdefault(rel, url)
+    for link in feed.get("links", []):
+        if link.get("href"):
+            links.setdefault(link.get("rel"), link["href"])
+    hub = links.get("hub") or feed.get("hub")
+    if not hub:
+        return None, None
+    return hub, links.get("self") or feed.get("self")
+
+def websub_id(feed: str) -> str:
+    """The part of a feed's WebSub callback URL that identifies the feed (followed by its push_token)."""
+
+    return hashlib.blake2b(feed.encode(), digest_size=8).hexdigest()
+
+def post_interval(entries) -> Optional[float]:
+    """The median gap (in seconds) between the publication dates of the given entries."""
+
+    stamps = sorted(time.mktime(t) for t in (e.get("published_parsed") or e.get("updated_parsed") for e in entries) if t)
+    gaps = [b - a for a, b in zip(stamps, stamps[1:]) if b > a]
+    return median(gaps) if gaps else None
+
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+RSS1_NS = "http://purl.org/rss/1.0/"
+RDF_ABOUT = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
+XML_BASE = "{http://www.w3.org/XML/1998/namespace}base"
+
+def split_tag(tag: str) -> Tuple[str, str]:
+    """Split an ElementTree tag into (namespace, local name)."""
+
+    if tag.startswith("{"):
+        ns, _, name = tag[1:].partition("}")
+        return ns, name
+    return "", tag
+
+def parse_date(text: str) -> Optional[time.struct_time]:
+    """Parse an RFC 822 (RSS) or ISO 8601 (Atom) date into a UTC struct_time, like feedparser's *_parsed fields."""
+
+    try:
+        when = parsedate_to_datetime(text)
+    except (TypeError, ValueError):
+        try:
+            when = datetime.fromisoformat(text)
+        except ValueError:
+            return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.utctimetuple()
+
+class FeedStream:
+    """An incremental RSS/Atom parser that hands back each entry as soon as its closing tag arrives.
+
+    Entries are dicts with the same keys feedparser would give them (as far as Entry and post_interval care), so
+    they're identified the same way whichever parser read them. Like feedparser, relative links are resolved against
+    xml:base and the feed's own URL. Feed-level polling hints end up in `meta`. Raises ElementTree.ParseError for
+    anything that isn't well-formed XML.
+    """
+
+    ENTRY_TAGS = {"item", "entry"}
+    META_TAGS = {"ttl": "ttl", "updatePeriod": "sy_updateperiod", "updateFrequency": "sy_updatefrequency"}
+
+    def __init__(self, url: str = "") -> None:
+        self.parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self.meta: Dict[str, str] = {}
+        self.depth = 0 # how many entry elements we're inside
+        self.bases = [url] # the base URL inside each element we're in
+
+    def feed(self, data: bytes) -> List[dict]:
+        self.parser.feed(data)
+        return self.read()
+
+    def close(self) -> List[dict]:
+        self.parser.close()
+        return self.read()
+
+    def read(self) -> List[dict]:
+        entries = []
+        for event, elem in self.parser.read_events():
+            _, name = split_tag(elem.tag)
+            if event == "start":
+                self.bases.append(urljoin(self.bases[-1], elem.get(XML_BASE)) if elem.get(XML_BASE) else self.bases[-1])
+            else:
+                base = self.bases.pop()
+            if name in self.ENTRY_TAGS:
+                if event == "start":
+                    self.depth += 1
+                    continue
+                self.depth -= 1
+                entries.append(self.entry(elem, base))
+                elem.clear()
+            elif event == "end" and self.depth == 0 and name in self.META_TAGS:
+                self.meta[self.META_TAGS[name]] = (elem.text or "").strip()
+            elif event == "end" and self.depth == 0 and name == "link" and elem.get("rel") in ("hub", "self") and elem.get("href"):
+                self.meta.setdefault(elem.get("rel"), urljoin(base, elem.get("href")))
+        return entries
+
+    @staticmethod
+    def entry(elem, base: str = "") -> dict:
+        def resolve(child, url: Optional[str]) -> Optional[str]:
+            if not url:
+                return url
+            return urljoin(urljoin(base, child.get(XML_BASE)) if child.get(XML_BASE) else base, url)
+
+        entry = {}
+        permalink = None
+        for child in elem:
+            ns, name = split_tag(child.tag)
+            if name == "guid" or (name == "id" and ns == ATOM_NS):
+                entry["id"] = (child.text or "").strip()
+                if name == "id" or child.get("isPermaLink", "true") != "false":
+                    # feedparser resolves these too, and they're part of the entry's identity
+                    entry["id"] = permalink = resolve(child, entry["id"])
+            elif name == "link" and ns == ATOM_NS:
+                if child.get("rel", "alternate") == "alternate" and "link" not in entry:
+                    entry["link"] = resolve(child, child.get("href"))
+            elif name == "link":
+                entry["link"] = resolve(child, (child.text or "").strip())
+            elif name == "title" and ns in ("", RSS1_NS, ATOM_NS, DC_NS): # not media:title
+                entry["title"] = "".join(child.itertext()).strip()
+            elif (name == "description" and ns in ("", RSS1_NS, DC_NS)) or (name == "summary" and ns == ATOM_NS):
+                entry["summary"] = "".join(child.itertext())
+            elif name == "encoded" or (name == "content" and ns == ATOM_NS):
+                entry["content"] = [feedparser.FeedParserDict(value="".join(child.itertext()))]
+            elif name in ("pubDate", "published", "updated", "date") and "published_parsed" not in entry:
+                entry["published_parsed"] = parse_date((child.text or "").strip())
+            elif (name == "author" and ns == ATOM_NS) and "author" not in entry:
+                entry["author"] = (child.findtext(f"{{{ATOM_NS}}}name") or "").strip() or None
+            elif (name == "author" or (name == "creator" and ns == DC_NS)) and "author" not in entry:
+                entry["author"] = (child.text or "").strip() or None
+            elif name == "thumbnail" and ns == MEDIA_NS:
+                entry.setdefault("media_thumbnail", []).append({"url": child.get("url")})
+            elif name == "content" and ns == MEDIA_NS:
+                entry.setdefault("media_content", []).append({"url": child.get("url"), "medium": child.get("medium"), "type": child.get("type")})
+            elif name == "enclosure":
+                entry.setdefault("enclosures", []).append({"href": resolve(child, child.get("url")), "type": child.get("type")})
+        if "id" not in entry and elem.get(RDF_ABOUT):
+            entry["id"] = elem.get(RDF_ABOUT)
+        if "link" not in entry and permalink is not None:
+            entry["link"] = permalink
+        return entry
+
+
+class ParsedFeed(NamedTuple):
+    status: int
+    url: str # after redirects
+    headers: CIMultiDict
+    feed: dict # feed-level elements, like feedparser's d.feed
+    entries: list # entry dicts, like feedparser's d.entries
+    fingerprint: Optional[str] = None # hash of the raw body
+
+
+def describe_error(err: BaseException) -> str:
+    """A short description of why a fetch failed, for notifications."""
+
+    if isinstance(err, TimeoutError):
+        return f"timed out after {FETCH_TIMEOUT:g}s"
+    return str(err) or type(err).__name__
 
 
 class FeedData:
+    __slots__ = ("url", "etag", "modified", "previous_entry", "seen", "feed_size", "interval", "next_due", "post_interval", "last_post", "hint", "unchanged", "streamable", "href", "fingerprint", "failures", "failing_since", "last_error", "primed", "hub", "topic", "push_token", "push_secret", "push_expires", "push_requested")
+
     @classmethod
     def from_dict(cls, **kwargs):
         self = cls(kwargs['url'])
         self.etag = kwargs['etag']
         self.modified = kwargs['modified']
-        self.previous_entry = Entry(kwargs['previous_entry'])
+        self.previous_entry = Entry.from_dict(kwargs['previous_entry']) if kwargs.get('previous_entry') else None
+        self.seen = dict.fromkeys(kwargs.get('seen', []))
+        self.feed_size = kwargs.get('feed_size', len(self.seen))
+        self.interval = kwargs.get('interval', RSS_FETCH_INTERVAL)
+        self.next_due = kwargs.get('next_due', 0.0)
+        self.post_interval = kwargs.get('post_interval', None)
+        self.last_post = kwargs.get('last_post', None)
+        self.hint = kwargs.get('hint', None)
+        self.unchanged = kwargs.get('unchanged', 0)
+        self.streamable = kwargs.get('streamable', True)
+        self.href = kwargs.get('href', None)
+        self.fingerprint = kwargs.get('fingerprint', None)
+        self.failures = kwargs.get('failures', 0)
+        self.failing_since = kwargs.get('failing_since', None)
+        self.last_error = kwargs.get('last_error', None)
+        self.primed = kwargs.get('primed', True)
+        self.hub = kwargs.get('hub', None)
+        self.topic = kwargs.get('topic', None)
+        self.push_token = kwargs.get('push_token', None)
+        self.push_secret = kwargs.get('push_secret', None)
+        self.push_expires = kwargs.get('push_expires', None)
+        self.push_requested = kwargs.get('push_requested', None)
         return self
 
     def __init__(self, url: str):
         self.url: str = url
         self.etag: Optional[str] = None
         self.modified: Optional[str] = None
-        self.previous_entry: Optional[Entry] = None #The most recent "nwewst entry" — e.g., entries[0] from the last time we fetched the feed
+        self.previous_entry: Optional[Entry] = None # Only set for feeds saved before `seen` existed; used once to seed it
+        self.seen: Dict[str, None] = {} # Entry.key() of recently seen entries, least recently seen first
+        self.feed_size: int = 0 # entries in the feed when it was last read to the end
+        self.interval: float = RSS_FETCH_INTERVAL # seconds between polls, adapted to how often the feed changes
+        self.next_due: float = 0.0 # UNIX time at which the feed should next be polled
+        self.post_interval: Optional[float] = None # typical seconds between posts
+        self.last_post: Optional[float] = None # UNIX time at which we last saw a new post
+        self.hint: Optional[float] = None # polling interval requested by the feed itself (<ttl> or sy:updatePeriod)
+        self.unchanged: int = 0 # consecutive polls (304s included) that turned up nothing new
+        self.streamable: bool = True # False once the feed has turned out not to be well-formed XML
+        self.href: Optional[str] = None # where the feed actually is, if fetching it gets redirected
+        self.fingerprint: Optional[str] = None # hash of the body we last parsed, for servers without ETag/Last-Modified
+        self.failures: int = 0 # consecutive polls that failed
+        self.failing_since: Optional[float] = None # UNIX time of the first of those failures
+        self.last_error: Optional[str] = None # why the last failed poll failed
+        self.primed: bool = False # whether the feed has ever been fetched (everything in it at that point counts as read)
+        self.hub: Optional[str] = None # the feed's WebSub hub, if it has one
+        self.topic: Optional[str] = None # the URL the hub knows the feed by
+        self.push_token: Optional[str] = None # random part of our callback URL, so only the hub knows it
+        self.push_secret: Optional[str] = None # our HMAC secret for the hub's pushes
+        self.push_expires: Optional[float] = None # UNIX time our (verified) push subscription runs out
+        self.push_requested: Optional[float] = None # UNIX time we last asked the hub to subscribe us
 
-    def new_entries(self):
-        verbose("in new_entries")
+    def to_dict(self):
+        d = {slot: getattr(self, slot) for slot in self.__slots__}
+        d['seen'] = list(self.seen)
         if self.previous_entry:
-            verbose(f"previous entry {self.previous_entry.title}")
+            d['previous_entry'] = self.previous_entry.to_dict()
         else:
-            verbose("no prev entry")
+            del d['previous_entry']
+        return d
+
+    def mark_seen(self, keys: List[str], complete: bool = True) -> None:
+        """Record that the given keys (newest first, as they appear in the feed) are in the feed right now.
+
+        The index is bounded, but never smaller than the feed itself, so an entry is only forgotten once it has
+        dropped out of the feed. If the keys aren't `complete` (reading stopped at the first entry already seen),
+        the feed is taken to be the size it was when last read to the end.
+        """
+
+        for key in reversed(keys):
+            self.seen.pop(key, None)
+            self.seen[key] = None
+        if complete:
+            self.feed_size = len(keys)
+        excess = len(self.seen) - max(SEEN_INDEX_SIZE, len(keys), self.feed_size)
+        if excess > 0:
+            for key in list(self.seen)[:excess]:
+                del self.seen[key]
+
+    @property
+    def circuit_open(self) -> bool:
+        return self.failures >= CIRCUIT_THRESHOLD
+
+    @property
+    def pushed(self) -> bool:
+        return bool(self.push_expires and self.push_expires > time.time())
+
+    def failed(self, error: Optional[str] = None) -> None:
+        """Record a failed poll, and back off: the polling interval doubles with every consecutive failure (up to
+        MAX_FETCH_INTERVAL), and once the circuit opens, the feed is only tried once a day until it works again.
+        """
+
+        now = time.time()
+        self.failures += 1
+        self.failing_since = self.failing_since or now
+        self.last_error = error or self.last_error or "unknown error"
+        if self.circuit_open:
+            delay = CIRCUIT_RETRY_INTERVAL
+        else:
+            delay = min(self.interval * 2 ** self.failures, MAX_FETCH_INTERVAL)
+        self.next_due = now + delay
+        verbose(f"{self.url}: failed {self.failures} times ({self.last_error}); next poll in {delay:.0f}s")
+
+    def reschedule(self, new_posts: int) -> None:
+        """Pick the next polling interval after a successful poll that found `new_posts` new entries."""
+
+        now = time.time()
+        self.primed = True
+        self.failures = 0
+        self.failing_since = None
+        self.last_error = None
+        if new_posts:
+            if self.last_post and not self.post_interval:
+                self.post_interval = now - self.last_post
+            elif self.last_post:
+                # Moving average, so a single burst of posts doesn't dominate
+                self.post_interval = 0.7 * self.post_interval + 0.3 * (now - self.last_post)
+            self.last_post = now
+            self.unchanged = 0
+        else:
+            self.unchanged += 1
+
+        # Poll about four times per typical gap between posts, and back off the longer a feed stays quiet
+        interval = self.post_interval / 4 if self.post_interval else RSS_FETCH_INTERVAL
+        interval *= 1.2 ** min(self.unchanged, 20)
+        if self.hint:
+            interval = max(interval, self.hint)
+        self.interval = min(max(interval, MIN_FETCH_INTERVAL), MAX_FETCH_INTERVAL)
+        if self.pushed:
+            # The hub tells us about new entries; polling is just in case it doesn't
+            self.interval = max(self.interval, WEBSUB_POLL_INTERVAL)
+        self.next_due = now + self.interval
+        verbose(f"{self.url}: next poll in {self.interval:.0f}s")
+
+    def defer(self, seconds: float) -> None:
+        """Put off a poll that wasn't sent because the feed's host asked us to back off (which isn't a failure)."""
+
+        self.next_due = time.time() + seconds
+        verbose(f"{self.url}: host backed off; next poll in {seconds:.0f}s")
+
+    def update_validators(self, headers) -> None:
+        etag = headers.get("ETag")
+        if etag and etag != self.etag:
+            verbose("new etag")
+            self.etag = etag
+        modified = headers.get("Last-Modified")
+        if modified and modified != self.modified:
+            verbose("new modified")
+            self.modified = modified
+
+    async def new_entries(self, fetcher: Fetcher) -> Optional[List[Entry]]:
+        verbose(f"in new_entries ({len(self.seen)} seen entries)")
+        if STREAMING_PARSE and self.streamable and not self.previous_entry:
+            return await self.stream_new_entries(fetcher)
+        return self.update(await self.fetch(fetcher), fetcher.metrics)
+
+    async def fetch(self, fetcher: Fetcher) -> Optional[ParsedFeed]:
+        """Fetch and parse the feed, returning None if either fails."""
+
         if self.etag or self.modified:
             verbose("etag/modified")
-            try:
-                d = feedparser.parse(self.url, etag=self.etag, modified=self.modified)
-            except:
-                print("ERR: feedparser.parse errored!")
-                print(self.url)
-                print(self.previous_entry)
-                print(self.etag)
-                print(self.modified)
-                return None
-            if d is None:
-                print("ERR: d is None")
-                print(self.url)
-                print(self.previous_entry)
-                print(self.etag)
-                print(self.modified)
-            if not hasattr(d, "status"):
-                print("ERR: no status attribute")
-                print(self.url)
-                print(self.previous_entry)
-                print(self.etag)
-                print(self.modified)
-                print(d)
-                return None
-            if d.status == 304:
-                verbose("status 304")
-                return []
-        else:
-            verbose("parsing normally")
-            d = feedparser.parse(self.url)
+        try:
+            response = await fetcher.fetch(self.url, etag=self.etag, modified=self.modified)
+        except HostBackedOff:
+            raise
+        except Exception as err:
+            print(f"ERR: fetching feed errored! {err=}")
+            print(self.url)
+            print(self.etag)
+            print(self.modified)
+            self.last_error = describe_error(err)
+            return None
+        if response.status == 304:
+            verbose("status 304")
+            return ParsedFeed(response.status, response.url, response.headers, {}, [])
+        if response.status >= 400:
+            print(f"ERR: status {response.status}")
+            print(self.url)
+            print(self.etag)
+            print(self.modified)
+            self.last_error = f"HTTP {response.status}"
+            return None
+        fingerprint = hashlib.blake2b(response.body, digest_size=16).hexdigest()
+        if fingerprint == self.fingerprint:
+            verbose("body unchanged")
+            fetcher.metrics.count("rssbot_unchanged_bodies_total")
+            return ParsedFeed(304, response.url, response.headers, {}, [], fingerprint)
 
+        verbose("parsing normally")
+        try:
+            d = await fetcher.parse(self.url, response)
+        except Exception as err:
+            print(f"ERR: feedparser.parse errored! {err=}")
+            print(self.url)
+            self.last_error = f"could not parse: {describe_error(err)}"
+            return None
         verbose("d has been parsed")
-        if "etag" in d:
-            if d.etag != self.etag:
-                verbose("new etag")
-                self.etag = d.etag
-        if "modified" in d:
-            if d.modified != self.modified:
-                verbose("new modified")
-                self.modified = d.modified
-
-        new_entries = []
-        for _entry in d.entries:
-            verbose(f"entry {_entry.get('title', _entry.get('link', '???'))}")
-            entry = Entry(_entry)
-            verbose(f"entry class {entry}")
-            if entry == self.previous_entry:
-                verbose("equal")
-                break
-            verbose("adding to list")
-            new_entries.append(entry)
+        return ParsedFeed(response.status, response.url, response.headers, d.feed, d.entries, fingerprint)
+
+    def update(self, parsed: Optional[ParsedFeed], metrics: Metrics) -> Optional[List[Entry]]:
+        """Take in a fetched copy of the feed (possibly fetched for an alias of this one), returning its new entries."""
 
-        if len(new_entries) == 0:
+        if parsed is None:
+            self.failed()
+            return None
+        if parsed.status == 304:
+            self.update_validators(parsed.headers)
+            self.reschedule(0)
             return []
 
-        self.previous_entry = new_entries[0]
-        verbose(self.previous_entry)
+        self.update_validators(parsed.headers)
+        self.fingerprint = parsed.fingerprint
+        self.href = parsed.url if parsed.url != self.url else None
+        self.hint = update_hint(parsed.feed)
+        self.hub, self.topic = websub_links(parsed.feed, parsed.headers)
+        self.post_interval = post_interval(parsed.entries) or self.post_interval
+
+        entries = [Entry(_entry) for _entry in parsed.entries]
+        keys = [entry.key() for entry in entries]
+        if self.previous_entry and not self.seen:
+            # Saved before the seen-entry index existed: everything above the previous entry is new, as it used to be
+            verbose(f"seeding seen entries from previous entry {self.previous_entry.title}")
+            new = range(next((i for i, entry in enumerate(entries) if entry == self.previous_entry), len(entries)))
+            self.previous_entry = None
+        else:
+            new = [i for i, key in enumerate(keys) if key not in self.seen]
+        new_entries = [entries[i] for i in new]
+        for i in new:
+            entries[i].add_details(parsed.entries[i])
+        self.mark_seen(keys)
+        verbose(f"{len(new_entries)} new of {len(entries)} entries")
+        metrics.feed(self.url).entries = len(new_entries)
+
+        self.reschedule(len(new_entries))
         return new_entries
 
+    async def stream_new_entries(self, fetcher: Fetcher) -> Optional[List[Entry]]:
+        """Like new_entries, but parse the feed as it downloads and stop reading at the first entry we've seen before.
+
+        If the feed isn't well-formed XML, it is parsed with feedparser instead, from now on.
+        """
+
+        stats = fetcher.metrics.feed(self.url)
+        raw_entries, entries, keys = [], [], []
+        try:
+            async with fetcher.open(self.url, etag=self.etag, modified=self.modified) as response:
+                if response.status == 304:
+                    verbose("status 304")
+                    self.reschedule(0)
+                    return []
+                if response.status >= 400:
+                    print(f"ERR: status {response.status}")
+                    print(self.url)
+                    print(self.etag)
+                    print(self.modified)
+                    self.failed(f"HTTP {response.status}")
+                    return None
+
+                stream = FeedStream(str(response.url))
+                stopped = False
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    stats.bytes += len(chunk)
+                    start = time.perf_counter()
+                    parsed = stream.feed(chunk)
+                    stats.parse_time += time.perf_counter() - start
+                    for _entry in parsed:
+                        entry = Entry(_entry)
+                        keys.append(entry.key())
+                        if keys[-1] in self.seen:
+                            stopped = True
+                            break
+                        raw_entries.append(_entry)
+                        entries.append(entry)
+                    if stopped:
+                        verbose(f"stopped reading at a seen entry after {len(entries)} new entries")
+                        break
+                else:
+                    for _entry in stream.close():
+                        entry = Entry(_entry)
+                        keys.append(entry.key())
+                        if keys[-1] not in self.seen:
+                            raw_entries.append(_entry)
+                            entries.append(entry)
+                headers = response.headers
+                href = str(response.url)
+        except ElementTree.ParseError as err:
+            print(f"{self.url} is not well-formed XML ({err}); parsing it with feedparser from now on")
+            self.streamable = False
+            return await self.new_entries(fetcher)
+        except HostBackedOff:
+            raise
+        except Exception as err:
+            print(f"ERR: fetching feed errored! {err=}")
+            print(self.url)
+            print(self.etag)
+            print(self.modified)
+            self.failed(describe_error(err))
+            return None
+
+        for entry, _entry in zip(entries, raw_entries):
+            entry.add_details(_entry)
+        self.update_validators(headers)
+        self.href = href if href != self.url else None
+        self.hint = update_hint(stream.meta)
+        self.hub, self.topic = websub_links(stream.meta, headers)
+        self.post_interval = post_interval(raw_entries) or self.post_interval
+        self.mark_seen(keys, complete=not stopped)
+        verbose(f"{len(entries)} new entries")
+        stats.entries = len(entries)
+
+        self.reschedule(len(entries))
+        return entries
+
+
+async def say(message: Message, msg: str) -> None:
+    await message.reply(msg)
+
+REGEX_FILTER_PREFIX = "re:"
+# Numbered or named backreferences, and conditionals on a group, which would refer to the wrong group once the
+# filter is combined with others
+GROUP_REFERENCE = re.compile(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?P=|\(\?\(")
+
+def regex_fragment(regex: str) -> str:
+    """A `re:` filter's regex as it goes into the combined regex of a filter list."""
+
+    # A leading (?i) would be a global flag in the combined regex, which Python doesn't allow there
+    return f"(?i:{regex[4:]})" if regex.startswith("(?i)") else f"(?:{regex})"
 
-async def say(message: Message, msg: str, maxrange: int = 3) -> None:
-    if maxrange < 1:
-        sleep_time = 0
-    elif maxrange == 1:
-        sleep_time = 1
-    else:
-        sleep_time = randrange(1, maxrange)
-    async with message.channel.typing():
-        await sleep(sleep_time)
-        await message.reply(msg)
+def filter_pattern(f: str) -> str:
+    """The regex for one filter: `re:regex` (`re:(?i)regex` for a case-insensitive one), and anything else as a literal
+    substring, as every filter was before regexes were supported.
+
+    Invalid regexes are matched literally.
+    """
+
+    if not f.startswith(REGEX_FILTER_PREFIX) or invalid_filter(f):
+        return re.escape(f)
+    return regex_fragment(f[len(REGEX_FILTER_PREFIX):])
+
+@lru_cache(maxsize=4096)
+def compile_filters(filters: Tuple[str, ...]) -> List[Pattern]:
+    """Combine a filter list into a single regex, so an entry is checked against all of them in one pass.
+
+    Compiled matchers are cached by filter list, so they're only rebuilt when a list actually changes (and channels
+    with identical lists share one). If the filters somehow can't be combined, each gets a regex of its own.
+    """
+
+    if not filters:
+        return []
+    try:
+        return [re.compile("|".join(filter_pattern(f) for f in filters))]
+    except re.error as err:
+        print(f"ERR: Cannot combine filters {filters!r}: {err!r}")
+        return [re.compile(filter_pattern(f)) for f in filters]
 
 def censored_by(entry, filters):
+    matchers = compile_filters(tuple(filters))
+    if not matchers:
+        return False
     output = entry.output()
-    for f in filters:
-        if f in output:
-            verbose(f"entry {output} censored by {f}")
+    for matcher in matchers:
+        match = matcher.search(output)
+        if match:
+            verbose(f"entry {output} censored by {match[0]!r}")
             return True
     return False
 
+def invalid_filter(f: str) -> Optional[str]:
+    """The error message if the filter is a regex that's invalid, or can't be combined with other filters (it has
+    global flags other than a leading (?i), named groups or backreferences), otherwise None."""
+
+    if not f.startswith(REGEX_FILTER_PREFIX):
+        return None
+    regex = f[len(REGEX_FILTER_PREFIX):]
+    if GROUP_REFERENCE.search(regex):
+        return "backreferences aren't supported in filters"
+    try:
+        pattern = re.compile(regex)
+    except re.error as err:
+        return str(err)
+    try:
+        # Exactly as it goes into the combined regex (older Pythons only warn about global flags that aren't at the start)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            re.compile("(?:)|" + regex_fragment(regex))
+    except (re.error, DeprecationWarning):
+        return "flags other than a leading (?i) aren't supported in filters"
+    if pattern.groupindex:
+        return "named groups aren't supported in filters"
+    return None
+
 def migration(feeds):
     # migrate from Dict[str, List[int]] to Dict[str, Dict[int, List[str]]]
     # was { feed -> [ channel ] }
@@ -184,28 +1098,1002 @@ def migration(feeds):
             processed_feeds[k] = {int(channel): [f for f in filters if isinstance(f, str)] for channel, filters in v.items() if (isinstance(channel, int) or isinstance(channel, str)) and isinstance(filters, list)}
     return processed_feeds
 
+
+def read_subscriptions(data: bytes) -> Dict[str, List[str]]:
+    """Read a list of feeds to import: OPML (every outline with an xmlUrl), or JSON (a list of URLs, or { url -> [ filter ] }
+    as written by `export json`). Raises ValueError if it's neither."""
+
+    text = data.decode("utf-8-sig", errors="replace").strip()
+    if text.startswith("<"):
+        try:
+            root = ElementTree.fromstring(text)
+        except ElementTree.ParseError as err:
+            raise ValueError(f"not valid OPML ({err})")
+        return {outline.get("xmlUrl").strip(): [] for outline in root.iter("outline") if outline.get("xmlUrl")}
+    try:
+        feeds = json.loads(text)
+    except json.JSONDecodeError as err:
+        raise ValueError(f"not valid OPML or JSON ({err})")
+    if isinstance(feeds, list):
+        return {url: [] for url in feeds if isinstance(url, str)}
+    if isinstance(feeds, dict):
+        return {url: [f for f in filters if isinstance(f, str)] if isinstance(filters, list) else [] for url, filters in feeds.items() if isinstance(url, str)}
+    raise ValueError("JSON must be a list of URLs or an object mapping URLs to filters")
+
+def write_opml(feeds: List[str]) -> bytes:
+    opml = ElementTree.Element("opml", version="2.0")
+    head = ElementTree.SubElement(opml, "head")
+    ElementTree.SubElement(head, "title").text = "RssBot feeds"
+    ElementTree.SubElement(head, "dateCreated").text = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S GMT")
+    body = ElementTree.SubElement(opml, "body")
+    for feed in feeds:
+        ElementTree.SubElement(body, "outline", type="rss", text=feed, xmlUrl=feed)
+    return ElementTree.tostring(opml, encoding="utf-8", xml_declaration=True)
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def canonical_url(url: str) -> str:
+    """Normalize a feed URL: lowercase scheme and host, and no default port, fragment or trailing slash.
+
+    This is only for comparing URLs (see feed_key): feeds are always fetched from a URL they were given or
+    redirected to, since some servers treat `/feed` and `/feed/` differently.
+    """
+
+    try:
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        netloc = (parts.hostname or "").lower()
+        if ":" in netloc:
+            netloc = f"[{netloc}]" # IPv6
+        if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+            netloc = f"{netloc}:{parts.port}"
+        if parts.username:
+            netloc = f"{parts.username}{':' + parts.password if parts.password else ''}@{netloc}"
+    except ValueError:
+        return url
+    return urlunsplit((scheme, netloc, parts.path.rstrip("/") or "/", parts.query, ""))
+
+def feed_key(url: str) -> str:
+    """What every URL for the same feed has in common: its canonical URL, minus the scheme (so http and https match)."""
+
+    return canonical_url(url).partition(":")[2]
+
+def index_channels(feeds: Dict[str, Dict[int, List[str]]]) -> Dict[int, Set[str]]:
+    """Invert { feed -> { channel -> [ filter ] } } into { channel -> { feed } }."""
+
+    channels: Dict[int, Set[str]] = {}
+    for feed, subscriptions in feeds.items():
+        for channel in subscriptions:
+            channels.setdefault(channel, set()).add(feed)
+    return channels
+
+
+async def check_group(datas: List[FeedData], new: List[bool], fetcher: Fetcher) -> List[Optional[List[Entry]]]:
+    """Check feeds that live at the same URL, fetching it just once, and return each one's new entries.
+
+    `new` marks the feeds that have never been fetched successfully; everything currently in them counts as read.
+    Feeds whose host has asked us to back off aren't fetched; they're put off until it's time (with None as result).
+    """
+
+    if len(datas) == 1 or new[0]:
+        results = []
+        for data, is_new in zip(datas, new):
+            if is_new:
+                verbose(f"{data.url}: first time checking; marking all posts as read")
+            try:
+                entries = await data.new_entries(fetcher)
+            except HostBackedOff as err:
+                data.defer(err.seconds)
+                entries = None
+            # Assume that newly-added blogs have had all their posts read already
+            results.append([] if is_new and entries is not None else entries)
+        return results
+
+    leader = datas[0]
+    try:
+        parsed = await leader.fetch(fetcher)
+    except HostBackedOff as err:
+        for data in datas:
+            data.defer(err.seconds)
+        return [None] * len(datas)
+    results = []
+    for data, is_new in zip(datas, new):
+        if parsed is None:
+            data.last_error = leader.last_error
+        entries = data.update(parsed, fetcher.metrics)
+        results.append([] if is_new and entries is not None else entries)
+        # Keep them on the same schedule, so they keep sharing fetches
+        data.interval = leader.interval
+        data.next_due = leader.next_due
+    return results
+
+
+class HashRing:
+    """Consistent hashing: maps keys to nodes so that changing the set of nodes moves as few keys as possible."""
+
+    def __init__(self, nodes, replicas: int = 64) -> None:
+        self.ring = sorted((self.hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [h for h, _ in self.ring]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def node(self, key: str):
+        return self.ring[bisect.bisect(self.hashes, self.hash(key)) % len(self.ring)][1]
+
+
+def shard_worker(requests, results) -> None:
+    """Entry point of a worker process: check the feed groups sent to it until it's sent None."""
+
+    async def serve():
+        fetcher = Fetcher(Metrics())
+        loop = get_running_loop()
+        tasks = set()
+
+        async def handle(request_id: int, datas: List[FeedData], new: List[bool]):
+            try:
+                entries = await check_group(datas, new, fetcher)
+                stats = {data.url: fetcher.metrics.feeds[data.url] for data in datas if data.url in fetcher.metrics.feeds}
+                results.put((request_id, datas, entries, stats, None))
+            except Exception as err:
+                results.put((request_id, None, None, None, f"{err!r}"))
+
+        while (request := await loop.run_in_executor(None, requests.get)) is not None:
+            task = create_task(handle(*request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await fetcher.close()
+
+    run(serve())
+
+
+class ShardPool:
+    """Worker processes that fetch and parse feeds, each one owning the feeds that consistent hashing assigns to it.
+
+    Workers keep no state between requests: every request carries the feeds' current FeedData, and every reply
+    brings it back, so this process stays the single source of truth. However feeds move between workers (as feeds
+    are added or removed, or WORKERS changes), no worker can check a feed from stale state and post entries twice.
+    Host politeness limits apply per worker.
+
+    A worker that dies is restarted, and its requests in flight fail (as does any request that takes longer than
+    SHARD_TIMEOUT), so a crash costs those feeds one check rather than stopping the update loop.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.requests = [self.context.Queue() for _ in range(workers)]
+        self.processes = [self.spawn(i) for i in range(workers)]
+        self.ring = HashRing(range(workers))
+        self.pending: Dict[int, Tuple[int, Future]] = {} # { request id -> (worker, reply) }
+        self.next_id = 0
+        self.reader: Optional[Task] = None
+        self.monitor: Optional[Task] = None
+
+    def spawn(self, shard: int) -> multiprocessing.Process:
+        return self.context.Process(target=shard_worker, args=(self.requests[shard], self.results), name=f"rssbot.shard.{shard}", daemon=True)
+
+    def start(self) -> None:
+        for process in self.processes:
+            process.start()
+        self.reader = create_task(self.read_results(), name="rssbot.shards")
+        self.monitor = create_task(self.watch_workers(), name="rssbot.shards.monitor")
+
+    def restart_dead(self) -> None:
+        for shard, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            print(f"ERR: worker process {shard} died (exit code {process.exitcode}); restarting it")
+            for request_id, (owner, future) in list(self.pending.items()):
+                if owner == shard:
+                    del self.pending[request_id]
+                    if not future.done():
+                        future.set_exception(RuntimeError(f"worker {shard} died"))
+            # Requests it hadn't picked up yet failed above; don't let the new worker run them too
+            self.requests[shard] = self.context.Queue()
+            self.processes[shard] = self.spawn(shard)
+            self.processes[shard].start()
+
+    async def watch_workers(self) -> None:
+        while True:
+            await sleep(5)
+            self.restart_dead()
+
+    async def read_results(self) -> None:
+        loop = get_running_loop()
+        while (reply := await loop.run_in_executor(None, self.results.get)) is not None:
+            request_id, datas, entries, stats, error = reply
+            _, future = self.pending.pop(request_id, (None, None))
+            if future is None or future.done():
+                continue # e.g. the request timed out, or the update task was restarted; its state is simply dropped
+            if error:
+                future.set_exception(RuntimeError(f"worker failed: {error}"))
+            else:
+                future.set_result((datas, entries, stats))
+
+    async def check(self, datas: List[FeedData], new: List[bool]):
+        """Check a group of aliases (see check_group) on the worker that owns them."""
+
+        shard = self.ring.node(feed_key(datas[0].href or datas[0].url))
+        request_id = self.next_id
+        self.next_id += 1
+        if not self.processes[shard].is_alive():
+            self.restart_dead()
+        future = get_running_loop().create_future()
+        self.pending[request_id] = (shard, future)
+        self.requests[shard].put((request_id, datas, new))
+        try:
+            return await wait_for(future, SHARD_TIMEOUT)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def close(self) -> None:
+        if self.monitor:
+            self.monitor.cancel()
+        for requests in self.requests:
+            requests.put(None)
+        self.results.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+class Delivery(NamedTuple):
+    feed: str
+    entries: List[Entry]
+    lines: List[str] # the entries rendered as text, under a header naming the feed
+
+    @classmethod
+    def render(cls, feed: str, entries: List[Entry]) -> "Delivery":
+        header = f"New post from {feed}:" if len(entries) == 1 else f"New posts from {feed}:"
+        return cls(feed, entries, [header] + [entry.output() for entry in entries])
+
+
+def plan_deliveries(feed: str, entries: List[Entry], subscriptions: Dict[int, List[str]]) -> Dict[int, Delivery]:
+    """Work out which of a feed's new entries each subscribed channel gets.
+
+    Channels with the same filters are filtered together, and share one rendered Delivery, so a feed with hundreds of
+    channels costs one pass per distinct filter list rather than one per channel.
+    """
+
+    channels_by_filters: Dict[Tuple[str, ...], List[int]] = {}
+    for channel_id, filters in subscriptions.items():
+        channels_by_filters.setdefault(tuple(filters), []).append(channel_id)
+
+    plan: Dict[int, Delivery] = {}
+    for filters, channels in channels_by_filters.items():
+        passed = [entry for entry in entries if not censored_by(entry, filters)]
+        if len(passed) == 0:
+            verbose(f"All entries in channels {channels} censored")
+            continue
+        delivery = Delivery.render(feed, passed)
+        for channel_id in channels:
+            plan[channel_id] = delivery
+    return plan
+
+
+def pack_messages(deliveries: List[Delivery]) -> List[str]:
+    """Pack queued deliveries into as few messages as fit in Discord's length limit."""
+
+    lines = [line for delivery in deliveries for line in delivery.lines]
+    messages = []
+    current = ""
+    for line in lines:
+        if len(line) > MESSAGE_LIMIT:
+            line = line[:MESSAGE_LIMIT - 1] + "…"
+        if current and len(current) + 1 + len(line) > MESSAGE_LIMIT:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+def pack_embeds(deliveries: List[Delivery]) -> List[List[Embed]]:
+    """Group queued deliveries' embeds into as few messages as Discord's embed limits allow."""
+
+    messages: List[List[Embed]] = []
+    current: List[Embed] = []
+    size = 0
+    for delivery in deliveries:
+        for entry in delivery.entries:
+            embed = entry.embed(delivery.feed)
+            if current and (len(current) == EMBEDS_PER_MESSAGE or size + len(embed) > EMBED_LIMIT):
+                messages.append(current)
+                current, size = [], 0
+            current.append(embed)
+            size += len(embed)
+    if current:
+        messages.append(current)
+    return messages
+
+
+class DeliveryQueue:
+    """Posts new entries to channels from per-channel worker tasks, so that fetching never waits on Discord.
+
+    A channel's worker runs while it has anything queued: it takes everything waiting for the channel, packs it into
+    as few messages as possible (lines of links, or embeds for channels in digest mode), and spaces its sends by CHANNEL_MIN_INTERVAL to stay clear of Discord's per-channel
+    rate limits (discord.py itself waits out any 429s on the rate-limit bucket).
+    """
+
+    def __init__(self, client: "RssBot") -> None:
+        self.client = client
+        self.queues: Dict[int, Queue] = {}
+        self.workers: Dict[int, Task] = {}
+        self.limiters: Dict[int, Limiter] = {}
+
+    def put(self, channel_id: int, deliveries: List[Delivery]) -> None:
+        if channel_id not in self.queues:
+            self.queues[channel_id] = Queue()
+        for delivery in deliveries:
+            self.queues[channel_id].put_nowait(delivery)
+        if channel_id not in self.workers:
+            self.workers[channel_id] = create_task(self.worker(channel_id), name=f"rssbot.deliver.{channel_id}")
+
+    async def worker(self, channel_id: int) -> None:
+        queue = self.queues[channel_id]
+        limiter = self.limiters.setdefault(channel_id, Limiter(1, CHANNEL_MIN_INTERVAL))
+        try:
+            while not queue.empty():
+                deliveries = []
+                while not queue.empty():
+                    deliveries.append(queue.get_nowait())
+
+                channel = self.client.get_channel(channel_id)
+                if not channel:
+                    # Consider automatically removing this channel?
+                    feeds = ", ".join(sorted({delivery.feed for delivery in deliveries}))
+                    print(f"ERR: Cannot get channel <#{channel_id}> to update {feeds}")
+                    await self.client.notify(f"Error! Cannot get channel <#{channel_id}> to update {feeds}")
+                    continue
+
+                if self.client.channel_modes.get(channel_id) == "digest":
+                    messages = [{"embeds": embeds} for embeds in pack_embeds(deliveries)]
+                else:
+                    messages = [{"content": content} for content in pack_messages(deliveries)]
+                for message in messages:
+                    async with limiter:
+                        try:
+                            start = time.perf_counter()
+                            await channel.send(**message)
+                            self.client.metrics.count("rssbot_messages_sent_total")
+                            self.client.metrics.count("rssbot_message_send_seconds_total", time.perf_counter() - start)
+                        except HTTPException as err:
+                            print(f"ERR: Cannot send to <#{channel_id}>: {err}")
+                            self.client.metrics.count("rssbot_message_errors_total")
+        finally:
+            del self.workers[channel_id]
+            del self.queues[channel_id]
+
+    async def close(self) -> None:
+        for worker in self.workers.values():
+            worker.cancel()
+
+
+class LazyFeedData(MutableMapping):
+    """{ url -> FeedData }, which only loads a feed's state from the store the first time it's used.
+
+    Until then, all that's in memory is when the feed is next due and where it redirects to (see next_due and href),
+    which is all that scheduling and finding aliases need, so starting up doesn't mean parsing every feed's state.
+
+    With a `capacity`, `trim` unloads the least recently used feeds' state beyond it. That doesn't write anything:
+    every change to a feed's state is saved through the `writer`, and state that's still waiting to be written is
+    loaded back from the writer rather than the store.
+    """
+
+    def __init__(self, store: Optional["StateStore"] = None, index: Optional[Dict[str, Tuple[float, Optional[str]]]] = None, loaded: Optional[Dict[str, "FeedData"]] = None, capacity: int = 0, writer: Optional["StateWriter"] = None) -> None:
+        self.store = store
+        self.index: Dict[str, Tuple[float, Optional[str]]] = index or {} # { url -> (next_due, href) }, for feeds not loaded yet
+        self.loaded: OrderedDict[str, FeedData] = OrderedDict(loaded or {}) # least recently used first
+        self.capacity = capacity # 0 for no limit
+        self.writer = writer
+
+    def __getitem__(self, url: str) -> "FeedData":
+        data = self.loaded.get(url)
+        if data is not None:
+            self.loaded.move_to_end(url)
+            return data
+        if url not in self.index:
+            raise KeyError(url)
+        data = self.writer.latest(url) if self.writer else None
+        if data is None:
+            data = self.store.load_feed_data(url)
+        self.loaded[url] = data
+        del self.index[url]
+        return data
+
+    def __setitem__(self, url: str, data: "FeedData") -> None:
+        self.index.pop(url, None)
+        self.loaded[url] = data
+
+    def __delitem__(self, url: str) -> None:
+        if url in self.loaded:
+            del self.loaded[url]
+        else:
+            del self.index[url]
+
+    def __contains__(self, url) -> bool:
+        return url in self.loaded or url in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.loaded) + list(self.index))
+
+    def __len__(self) -> int:
+        return len(self.loaded) + len(self.index)
+
+    def next_due(self, url: str) -> Optional[float]:
+        if url in self.loaded:
+            return self.loaded[url].next_due
+        return self.index[url][0] if url in self.index else None
+
+    def href(self, url: str) -> Optional[str]:
+        if url in self.loaded:
+            return self.loaded[url].href
+        return self.index[url][1] if url in self.index else None
+
+    def peek(self, url: str) -> Optional["FeedData"]:
+        """A feed's state if it's loaded, without loading it (or counting as a use)."""
+
+        return self.loaded.get(url)
+
+    def trim(self, keep: Set[str] = frozenset()) -> int:
+        """Unload the least recently used feeds' state until no more than `capacity` feeds' is loaded, except for the
+        feeds in `keep` (which are in use). Returns how many were unloaded."""
+
+        if not self.capacity or len(self.loaded) <= self.capacity:
+            return 0
+        excess = len(self.loaded) - self.capacity
+        evicted = []
+        for url, data in self.loaded.items():
+            if len(evicted) == excess:
+                break
+            if url not in keep:
+                evicted.append(url)
+                self.index[url] = (data.next_due, data.href)
+        for url in evicted:
+            del self.loaded[url]
+        return len(evicted)
+
+
+class StateStore:
+    """Persistent bot state in an SQLite database (in WAL mode).
+
+    All changes are made by `write`, a StateWriter's batch at a time, on the writer's thread. Each batch is one
+    transaction, so a crash at any point leaves the previous state intact. The first time the database is opened,
+    any feeds.json/feeddata.json/filters.json in the working directory are imported.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock() # the writer's thread and the event loop share the connection
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS subscriptions (url TEXT NOT NULL, channel INTEGER NOT NULL, filters TEXT NOT NULL, PRIMARY KEY (url, channel))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS feed_data (url TEXT PRIMARY KEY, data TEXT NOT NULL, next_due REAL NOT NULL DEFAULT 0, href TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS global_filters (position INTEGER PRIMARY KEY, filter TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS channel_modes (channel INTEGER PRIMARY KEY, mode TEXT NOT NULL)")
+            if "next_due" not in {column for _, column, *_ in self.db.execute("PRAGMA table_info(feed_data)")}:
+                # Databases from before LazyFeedData: copy what it needs out of the JSON
+                self.db.execute("ALTER TABLE feed_data ADD COLUMN next_due REAL NOT NULL DEFAULT 0")
+                self.db.execute("ALTER TABLE feed_data ADD COLUMN href TEXT")
+                rows = [json.loads(data) for data, in self.db.execute("SELECT data FROM feed_data")]
+                self.db.executemany("UPDATE feed_data SET next_due = ?, href = ? WHERE url = ?", ((d.get("next_due", 0.0), d.get("href"), d["url"]) for d in rows))
+
+    def load(self):
+        """Return (feeds, feed data, global filters), importing the legacy JSON files if this is a new database.
+
+        Feed data is a LazyFeedData, which reads each feed's state from here when it's first needed.
+        """
+
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'imported_json'").fetchone() is None:
+            self.import_json()
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'regex_filters'").fetchone() is None:
+            self.escape_filters()
+        feeds: Dict[str, Dict[int, List[str]]] = {}
+        for url, channel, filters in self.db.execute("SELECT url, channel, filters FROM subscriptions"):
+            feeds.setdefault(url, {})[channel] = json.loads(filters)
+        feed_data = LazyFeedData(self, {url: (next_due, href) for url, next_due, href in self.db.execute("SELECT url, next_due, href FROM feed_data")})
+        filters = [f for f, in self.db.execute("SELECT filter FROM global_filters ORDER BY position")]
+        return feeds, feed_data, filters
+
+    def escape_filters(self) -> None:
+        """Keep filters saved before regex filters existed meaning what they did, by rewriting the ones that happen to
+        start with REGEX_FILTER_PREFIX as regexes matching them literally."""
+
+        def escape(f: str) -> str:
+            return REGEX_FILTER_PREFIX + re.escape(f) if f.startswith(REGEX_FILTER_PREFIX) else f
+
+        with self.db:
+            rows = list(self.db.execute("SELECT url, channel, filters FROM subscriptions"))
+            self.db.executemany("UPDATE subscriptions SET filters = ? WHERE url = ? AND channel = ?", ((json.dumps([escape(f) for f in json.loads(filters)]), url, channel) for url, channel, filters in rows if REGEX_FILTER_PREFIX in filters))
+            rows = list(self.db.execute("SELECT position, filter FROM global_filters"))
+            self.db.executemany("UPDATE global_filters SET filter = ? WHERE position = ?", ((escape(f), position) for position, f in rows if f.startswith(REGEX_FILTER_PREFIX)))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('regex_filters', ?)", (datetime.now(timezone.utc).isoformat(),))
+
+    def import_json(self) -> None:
+        print("searching for feed files in working directory")
+        try:
+            with open("feeds.json", "r") as file:
+                feeds = migration(json.load(file))
+                print("...loaded feeds")
+        except:
+            print("...feeds not found")
+            feeds = {}
+        try:
+            with open("feeddata.json", "r") as file:
+                feed_data = json.load(file)
+                print("...loaded feed data")
+        except:
+            print("...feed data not found")
+            feed_data = {}
+        try:
+            with open("filters.json", "r") as file:
+                filters = json.load(file)
+                print("...loaded global filters")
+        except:
+            print("...global filters not found")
+            filters = []
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?)", ((url, channel, json.dumps(f)) for url, channels in feeds.items() for channel, f in channels.items()))
+            self.db.executemany("INSERT OR REPLACE INTO feed_data VALUES (?, ?, ?, ?)", ((url, json.dumps(data), data.get("next_due", 0.0), data.get("href")) for url, data in feed_data.items()))
+            self.db.executemany("INSERT OR REPLACE INTO global_filters VALUES (?, ?)", enumerate(filters))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('imported_json', ?)", (datetime.now(timezone.utc).isoformat(),))
+
+    def load_feed_data(self, url: str) -> "FeedData":
+        with self.lock:
+            row = self.db.execute("SELECT data FROM feed_data WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            raise KeyError(url)
+        return FeedData.from_dict(**json.loads(row[0]))
+
+    def load_channel_modes(self) -> Dict[int, str]:
+        return dict(self.db.execute("SELECT channel, mode FROM channel_modes"))
+
+    def write(self, subscriptions: List[Tuple[str, int, Optional[str]]], feed_data: List[Tuple[str, Optional[str], float, Optional[str]]], channel_modes: List[Tuple[int, Optional[str]]], global_filters: Optional[List[str]]) -> None:
+        """Make a StateWriter's batch of changes in one transaction. Rows whose data (or mode) is None are deleted."""
+
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM subscriptions WHERE url = ? AND channel = ?", ((url, channel) for url, channel, filters in subscriptions if filters is None))
+            self.db.executemany("INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?)", (row for row in subscriptions if row[2] is not None))
+            self.db.executemany("DELETE FROM feed_data WHERE url = ?", ((url,) for url, data, *_ in feed_data if data is None))
+            self.db.executemany("INSERT OR REPLACE INTO feed_data VALUES (?, ?, ?, ?)", (row for row in feed_data if row[1] is not None))
+            self.db.executemany("DELETE FROM channel_modes WHERE channel = ?", ((channel,) for channel, mode in channel_modes if mode is None))
+            self.db.executemany("INSERT OR REPLACE INTO channel_modes VALUES (?, ?)", (row for row in channel_modes if row[1] is not None))
+            if global_filters is not None:
+                self.db.execute("DELETE FROM global_filters")
+                self.db.executemany("INSERT INTO global_filters VALUES (?, ?)", enumerate(global_filters))
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class StateWriter:
+    """Changes to the bot's state, collected for SAVE_DELAY seconds and then written to the store in one go.
+
+    A later change to the same row replaces an earlier one, so a burst of commands (or a check of many feeds) costs
+    one transaction, which runs on a thread of its own so that the event loop never waits for the disk. Feed state
+    is serialized when it's written, not when it's saved, so it's always the latest. Anything not yet written when
+    the bot closes is written then.
+    """
+
+    def __init__(self, store: StateStore, delay: float = SAVE_DELAY) -> None:
+        self.store = store
+        self.delay = delay
+        self.subscriptions: Dict[Tuple[str, int], Optional[List[str]]] = {} # None to delete
+        self.feed_data: Dict[str, Optional["FeedData"]] = {} # None to delete
+        self.channel_modes: Dict[int, Optional[str]] = {} # None to delete
+        self.global_filters: Optional[List[str]] = None
+        self.writing: List[Dict[str, Optional["FeedData"]]] = [] # feed state in batches being written, oldest first
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rssbot.save")
+        self.task: Optional[Task] = None
+
+    @property
+    def pending(self) -> bool:
+        return bool(self.subscriptions or self.feed_data or self.channel_modes or self.global_filters is not None)
+
+    def latest(self, url: str) -> Optional["FeedData"]:
+        """A feed's state if it hasn't all been written to the store yet (and so mustn't be loaded from there)."""
+
+        for batch in [self.feed_data, *reversed(self.writing)]:
+            if url in batch:
+                return batch[url]
+        return None
+
+    def changed(self) -> None:
+        if self.task is not None:
+            return
+        try:
+            get_running_loop()
+        except RuntimeError:
+            return # no event loop yet: written by the first flush
+        self.task = create_task(self.flush_later())
+
+    def save_subscription(self, url: str, channel: int, filters: List[str]) -> None:
+        self.subscriptions[(url, channel)] = list(filters)
+        self.changed()
+
+    def delete_subscription(self, url: str, channel: int) -> None:
+        self.subscriptions[(url, channel)] = None
+        self.changed()
+
+    def save_feed_data(self, *feed_data: "FeedData") -> None:
+        for data in feed_data:
+            self.feed_data[data.url] = data
+        self.changed()
+
+    def delete_feed_data(self, url: str) -> None:
+        self.feed_data[url] = None
+        self.changed()
+
+    def save_channel_mode(self, channel: int, mode: Optional[str]) -> None:
+        self.channel_modes[channel] = mode
+        self.changed()
+
+    def save_global_filters(self, filters: List[str]) -> None:
+        self.global_filters = list(filters)
+        self.changed()
+
+    async def flush_later(self) -> None:
+        await sleep(self.delay)
+        self.task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write everything changed so far (and wait for it to be written)."""
+
+        if not self.pending:
+            return
+        subscriptions, feed_data, channel_modes, global_filters = self.subscriptions, self.feed_data, self.channel_modes, self.global_filters
+        self.subscriptions, self.feed_data, self.channel_modes, self.global_filters = {}, {}, {}, None
+        rows = (
+            [(url, channel, None if filters is None else json.dumps(filters)) for (url, channel), filters in subscriptions.items()],
+            [(url, None, 0.0, None) if data is None else (url, json.dumps(data.to_dict()), data.next_due, data.href) for url, data in feed_data.items()],
+            list(channel_modes.items()),
+            global_filters,
+        )
+        start = time.perf_counter()
+        self.writing.append(feed_data)
+        try:
+            await get_running_loop().run_in_executor(self.executor, self.store.write, *rows)
+        except Exception as err:
+            print(f"ERR: Cannot save state (will retry): {err!r}")
+            # Put back whatever hasn't been changed again since
+            for pending, failed in ((self.subscriptions, subscriptions), (self.feed_data, feed_data), (self.channel_modes, channel_modes)):
+                for key, value in failed.items():
+                    pending.setdefault(key, value)
+            if self.global_filters is None:
+                self.global_filters = global_filters
+            self.changed()
+            return
+        finally:
+            self.writing = [batch for batch in self.writing if batch is not feed_data]
+        verbose(f"Saved {len(rows[0])} subscriptions and {len(rows[1])} feeds in {time.perf_counter() - start:.3f}s")
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+        self.executor.shutdown()
+
+
+class Command(NamedTuple):
+    handler: Callable[..., Awaitable[None]] # an RssBot method taking the message and its arguments
+    args: Optional[int] # arguments to split the rest of the message into (the last gets the rest), or None for every word
+    required: int # arguments without which the command isn't run
+    usage: Optional[str] # shown when arguments are missing
+    admin: bool # only the admin may run it
+
+
+# { (command,) or (command, subcommand) -> Command }, filled in by @command
+COMMANDS: Dict[Tuple[str, ...], Command] = {}
+
+
+def command(*names: str, args: Optional[int] = 0, required: int = 0, usage: Optional[str] = None, admin: bool = False):
+    """Register an RssBot method as the handler for a command, or for a subcommand (`@command("filter", "add")`).
+
+    A command's own handler also gets its subcommands that have no handler of their own, as its first argument.
+    """
+
+    def register(handler):
+        COMMANDS[names] = Command(handler, args, required, usage, admin)
+        return handler
+    return register
+
+
+def parse_command(text: str) -> Tuple[Tuple[str, ...], List[str]]:
+    """The command (and subcommand) a message runs, and its arguments, from the message with the mention removed.
+
+    The command may not be in COMMANDS (it's unknown).
+    """
+
+    name, _, rest = text.partition(" ")
+    sub, _, subrest = rest.partition(" ")
+    key = (name, sub) if (name, sub) in COMMANDS else (name,)
+    if len(key) == 2:
+        rest = subrest
+    spec = COMMANDS.get(key)
+    if spec is None or spec.args == 0:
+        return key, []
+    if spec.args is None:
+        return key, rest.split()
+    return key, rest.split(" ", spec.args - 1) if rest else []
+
+
 class RssBot(Client):
-    def __init__(self, feeds: Dict[str, Dict[int, List[str]]], feed_data: Dict[str, FeedData], global_filters: List[str], **options) -> None:
+    def __init__(self, feeds: Dict[str, Dict[int, List[str]]], feed_data: MutableMapping[str, FeedData], global_filters: List[str], store: StateStore, **options) -> None:
         super().__init__(intents=Intents(guilds=True, messages=True), **options)
         # { feed -> { channel -> [ filter ] } }
         self.feeds: Dict[str, Dict[int, List[str]]] = migration(feeds)
-        self.feed_data: Dict[str, FeedData] = feed_data
+        self.feed_data: LazyFeedData = feed_data if isinstance(feed_data, LazyFeedData) else LazyFeedData(store, loaded=feed_data)
         self.global_filters: List[str] = global_filters
+        self.store = store
+        self.writer = StateWriter(store)
+        self.feed_data.capacity = FEED_CACHE_SIZE
+        self.feed_data.writer = self.writer
+        # { feed_key(url) -> feed }, for every URL (including redirect targets) a feed is known by
+        self.aliases: Dict[str, str] = {}
+        # { channel -> { feed } }, kept in sync with self.feeds by subscribe(), unsubscribe() and merge_feeds()
+        self.channels: Dict[int, Set[str]] = index_channels(self.feeds)
+        self.merge_aliases()
+        # { channel -> delivery mode }, for channels that aren't in the default ("links") mode
+        self.channel_modes: Dict[int, str] = store.load_channel_modes()
+        for feed in self.feeds:
+            self.add_aliases(feed)
         self.task = None
+        self.queue: List[Tuple[float, str]] = []
+        self.scheduled: Dict[str, float] = {}
+        self.wake = Event()
+        self.last_check = datetime.now(timezone.utc)
+        self.metrics = Metrics()
+        self.fetcher: Optional[Fetcher] = None
+        self.shards: Optional[ShardPool] = None
+        self.web: Optional[web.AppRunner] = None
+        self.delivery = DeliveryQueue(self)
+        self.checking: Set[str] = set() # feeds being checked right now
+        self.push_callbacks: Dict[str, str] = {} # { websub_id(feed) -> feed }
+        self.push_unsubscribing: Dict[str, str] = {} # { callback path -> topic } for unsubscriptions not yet verified
+        self.tasks: Set[Task] = set() # background tasks, referenced until they finish
         self.ADMIN_UID = int(os.getenv('ADMIN_UID', 377776843425841153))
         self.DEBUG_CHANNEL = int(os.getenv('DEBUG_CHANNEL', 1080991601502986331))
 
+    async def setup_hook(self) -> None:
+        orphans = self.collect_garbage()
+        if orphans:
+            print(f"Dropped the state of {orphans} feeds that are no longer watched")
+        await self.writer.flush() # anything merge_aliases or collect_garbage changed
+        self.fetcher = Fetcher(self.metrics)
+        if WORKERS:
+            self.shards = ShardPool(WORKERS)
+            self.shards.start()
+            print(f"Started {WORKERS} worker processes")
+        if HTTP_PORT:
+            app = web.Application()
+            app.router.add_get("/metrics", self.serve_metrics)
+            if WEBSUB_URL:
+                app.router.add_get("/websub/{feed_id}/{token}", self.verify_push)
+                app.router.add_post("/websub/{feed_id}/{token}", self.receive_push)
+            self.web = web.AppRunner(app)
+            await self.web.setup()
+            await web.TCPSite(self.web, HTTP_HOST, HTTP_PORT).start()
+            print(f"Serving metrics on http://{HTTP_HOST}:{HTTP_PORT}/metrics")
+            if WEBSUB_URL:
+                print(f"Receiving WebSub pushes at {WEBSUB_URL}/websub/")
+
+    async def serve_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    async def close(self) -> None:
+        await super().close()
+        if self.fetcher:
+            await self.fetcher.close()
+        if self.shards:
+            self.shards.close()
+        await self.delivery.close()
+        for task in self.tasks:
+            task.cancel()
+        if self.web:
+            await self.web.cleanup()
+        await self.writer.close()
+        self.store.close()
+
     async def notify(self, msg: str) -> None:
         await self.get_channel(self.DEBUG_CHANNEL).send(msg)
 
-    def dump_feeds_to_file(self):
-        verbose("Updating dump files")
-        with open("feeds.json", "w") as file:
-            json.dump(self.feeds, file, default=lambda o: o.__dict__, sort_keys=True, indent=4)
-        with open("feeddata.json", "w") as file:
-            json.dump(self.feed_data, file, default=lambda o: o.__dict__, sort_keys=True, indent=4)
-        with open("filters.json", "w") as file:
-            json.dump(self.global_filters, file, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+    def merge_aliases(self) -> None:
+        """Merge feeds that are really the same feed under different URLs.
+
+        Two feeds are the same if their URLs have the same feed_key, or if one redirects to the other. Subscriptions
+        (and their filters) are combined, and so are the feeds' seen entries, so that nothing is reposted. The merged
+        feed keeps one of the URLs it was added under, as given, since that's the URL that's fetched.
+        """
+
+        groups: Dict[str, List[str]] = {}
+        for feed in self.feeds:
+            href = self.feed_data.href(feed)
+            groups.setdefault(feed_key(href or feed), []).append(feed)
+
+        for group in groups.values():
+            if len(group) > 1:
+                self.merge_feeds(group)
+
+    def merge_feeds(self, group: List[str]) -> str:
+        """Merge feeds that are the same feed into one (see merge_aliases), returning the URL it keeps."""
+
+        # Prefer the URL the others redirect to, then https
+        group = sorted(group, key=lambda f: (self.feed_data.href(f) is not None, not f.startswith("https:"), len(f), f))
+        target = group[0]
+        print(f"merging {', '.join(group)} into {target}")
+
+        subscriptions: Dict[int, List[str]] = {}
+        for feed in group:
+            self.aliases[feed_key(feed)] = target
+            for channel, filters in self.feeds.pop(feed).items():
+                merged = subscriptions.setdefault(channel, [])
+                merged.extend(f for f in filters if f not in merged)
+                self.writer.delete_subscription(feed, channel)
+                self.channels[channel].discard(feed)
+        self.feeds[target] = subscriptions
+        for channel, filters in subscriptions.items():
+            self.writer.save_subscription(target, channel, filters)
+            self.channels[channel].add(target)
+
+        datas = [self.feed_data.pop(feed) for feed in group if feed in self.feed_data]
+        if datas:
+            data = datas[0]
+            for other in datas[1:]:
+                data.seen = {**other.seen, **data.seen}
+            for other in datas:
+                self.writer.delete_feed_data(other.url)
+            data.url = target
+            self.feed_data[target] = data
+            self.writer.save_feed_data(data)
+        return target
+
+    def merge_redirects(self, feeds: List[str]) -> Dict[str, str]:
+        """Merge the given feeds into the watched feeds they turned out to redirect to (or the other way round), as
+        merge_aliases would on the next start. Returns { feed merged away -> feed it was merged into }."""
+
+        renamed: Dict[str, str] = {}
+        for feed in feeds:
+            href = self.feed_data.href(feed) if feed in self.feeds else None
+            other = self.aliases.get(feed_key(href)) if href else None
+            if other is None or other == feed or other not in self.feeds:
+                continue
+            target = self.merge_feeds([feed, other])
+            for merged in (feed, other):
+                if merged != target:
+                    renamed[merged] = target
+                    self.scheduled.pop(merged, None)
+                    self.metrics.feeds.pop(merged, None)
+        return renamed
+
+    def add_aliases(self, feed: str) -> None:
+        self.aliases[feed_key(feed)] = feed
+        href = self.feed_data.href(feed)
+        if href:
+            self.aliases.setdefault(feed_key(href), feed)
+
+    def resolve(self, url: str) -> str:
+        """The feed we already watch under another URL for the same feed (if any), otherwise the URL as given."""
+
+        feed = self.aliases.get(feed_key(url))
+        return feed if feed in self.feeds else url.strip()
+
+    def subscribe(self, feed: str, channel_id: int, filters: Optional[List[str]] = None, save: bool = True) -> bool:
+        """Start watching a feed in a channel. Returns whether the feed is new."""
+
+        new_feed = feed not in self.feeds
+        self.feeds.setdefault(feed, {})[channel_id] = filters or []
+        if new_feed:
+            self.add_aliases(feed)
+            if self.task:
+                self.schedule(feed)
+        self.channels.setdefault(channel_id, set()).add(feed)
+        if save:
+            self.writer.save_subscription(feed, channel_id, self.feeds[feed][channel_id])
+        return new_feed
+
+    async def import_feeds(self, channel_id: int, subscriptions: Dict[str, List[str]]) -> str:
+        """Subscribe a channel to many feeds at once, returning a summary for the user.
+
+        New feeds are all test-fetched concurrently, which also marks everything currently in them as read (just like
+        the first check of a feed added with `add`). Everything is saved in one write at the end.
+        """
+
+        invalid, existing, accepted = [], [], {}
+        keys: Set[str] = set() # feed_key of everything accepted, so two URLs for one feed aren't both added
+        for url, filters in subscriptions.items():
+            if not validators.url(url):
+                invalid.append(url)
+                continue
+            feed = self.resolve(url)
+            if feed in self.feeds_in(channel_id) or feed_key(feed) in keys:
+                existing.append(feed)
+            else:
+                accepted[feed] = [f for f in filters if not invalid_filter(f)]
+                keys.add(feed_key(feed))
+
+        new_feeds = [feed for feed in accepted if feed not in self.feeds and feed not in self.feed_data]
+        datas = [FeedData(feed) for feed in new_feeds]
+        results = await gather(*(data.new_entries(self.fetcher) for data in datas), return_exceptions=True)
+        unreachable = {data.url for data, result in zip(datas, results) if result is None or isinstance(result, BaseException)}
+
+        imported = [(feed, channel_id, filters) for feed, filters in accepted.items() if feed not in unreachable]
+        primed = [data for data in datas if data.url not in unreachable]
+        for data in primed:
+            self.feed_data[data.url] = data
+        for feed, _, filters in imported:
+            self.subscribe(feed, channel_id, filters, save=False)
+        for feed, _, filters in imported:
+            self.writer.save_subscription(feed, channel_id, filters)
+        self.writer.save_feed_data(*primed)
+
+        def some(urls):
+            return ", ".join(urls[:5]) + (f" and {len(urls) - 5} more" if len(urls) > 5 else "")
+        lines = [f"Imported {len(imported)} feed{'s' if len(imported) != 1 else ''} ({len(primed)} new to RssBot)"]
+        if existing:
+            lines.append(f"Already watching {len(existing)}: {some(existing)}")
+        if invalid:
+            lines.append(f"Not valid URLs ({len(invalid)}): {some(invalid)}")
+        if unreachable:
+            lines.append(f"Could not be fetched ({len(unreachable)}): {some(sorted(unreachable))}")
+        return "\n".join(lines)
+
+    def unsubscribe(self, feed: str, channel_id: int) -> bool:
+        """Stop watching a feed in a channel. Returns whether that was the feed's last channel (and it is now removed)."""
+
+        del self.feeds[feed][channel_id]
+        self.channels[channel_id].discard(feed)
+        if len(self.channels[channel_id]) == 0:
+            del self.channels[channel_id]
+        self.writer.delete_subscription(feed, channel_id)
+        if len(self.feeds[feed]) == 0:
+            del self.feeds[feed]
+            data = self.feed_data.get(feed)
+            if WEBSUB_URL and data and data.pushed:
+                self.background(self.websub_request(data, "unsubscribe"))
+            self.forget(feed)
+            return True
+        return False
+
+    def forget(self, feed: str) -> None:
+        """Drop everything kept about a feed that's no longer watched (if it's added again, it starts afresh)."""
+
+        self.scheduled.pop(feed, None)
+        self.metrics.feeds.pop(feed, None)
+        href = self.feed_data.href(feed)
+        for url in (feed, href):
+            if url and self.aliases.get(feed_key(url)) == feed:
+                del self.aliases[feed_key(url)]
+        if feed in self.feed_data:
+            del self.feed_data[feed]
+            self.writer.delete_feed_data(feed)
+
+    def collect_garbage(self) -> int:
+        """Forget the feeds that have state but no subscriptions (such as those left behind by older versions, which
+        kept the state of removed feeds). Returns how many there were."""
+
+        orphans = [feed for feed in self.feed_data if feed not in self.feeds]
+        for feed in orphans:
+            self.forget(feed)
+        return len(orphans)
+
+    def save_feed_state(self, feeds: List[str]) -> None:
+        """Save the state of feeds that were just checked, then unload the least recently used feeds' state if there's
+        more than FEED_CACHE_SIZE (see LazyFeedData.trim)."""
+
+        self.writer.save_feed_data(*(self.feed_data[feed] for feed in feeds if feed in self.feed_data))
+        self.feed_data.trim(keep=self.checking)
+
+    def feeds_in(self, channel_id: int) -> Set[str]:
+        return self.channels.get(channel_id, set())
 
     async def update_status(self) -> None:
         feed_count = len(self.feeds)
@@ -237,345 +2125,737 @@ class RssBot(Client):
         if "<@1080989856248893521>" not in message.content:
             return  # A reply to us that doesn't tag us
 
-        if isinstance(message.channel, DMChannel):
-            def log(s: str):
-                print(f"[{datetime.now(timezone.utc).isoformat()}] {s} in DM with {message.author} ({message.channel.id})")
-        elif isinstance(message.channel, GroupChannel):
-            def log(s: str):
-                print(f"[{datetime.now(timezone.utc).isoformat()}] {s} in group DM {f'{message.channel.name} ({message.channel.id})' if message.channel.name else message.channel.id} from {message.author}")
-        else:
-            def log(s: str):
-                print(f"[{datetime.now(timezone.utc).isoformat()}] {s} to #{message.channel.name} ({message.channel.id}) from {message.author}")
-
         # if message.author.id != 377776843425841153:
         #     print(f"Request from {message.author} ({message.author.id})")
         #     await say(message, "Unauthorized user")
         #     return
 
-        msg = message.content.split(">", maxsplit=1)[1].strip(" ")
-        _msg = msg.split(" ", maxsplit=1)
-        cmd = _msg[0]
-        if cmd == "add":
-            url = _msg[1]
-            log(f"Request to add '{url}'")
-            if url in self.feeds:
-                if message.channel.id in self.feeds[url]:
-                    print("Already watching feed in channel")
-                    await say(message, f"Already watching {url} in this channel")
-                else:
-                    self.feeds[url][message.channel.id] = []
-                    print("Now watching feed (existing feed)")
-                    self.dump_feeds_to_file()
-                    await say(message, f"Now watching {url} in this channel")
+        await self.run_command(message, message.content.split(">", maxsplit=1)[1].strip(" "))
+
+    async def run_command(self, message: Message, text: str) -> None:
+        """Run the command in a message (with the mention removed), timing it for the metrics."""
+
+        key, args = parse_command(text)
+        spec = COMMANDS.get(key)
+        name = " ".join(key) if spec else "unknown"
+        start = time.perf_counter()
+        failed = True
+        try:
+            if spec is None:
+                await self.unknown_command(message, key[0])
+            elif spec.admin and message.author.id != self.ADMIN_UID:
+                self.log_request(message, f"Unauthorized request for {name}")
+                await say(message, "Unauthorized user")
+            elif len(args) < spec.required:
+                self.log_request(message, f"Request for {name} with missing arguments")
+                await say(message, f"Missing arguments (try \"<@1080989856248893521> {spec.usage or name}\")")
+            else:
+                await spec.handler(self, message, args)
+            failed = False
+        finally:
+            self.metrics.command(name, time.perf_counter() - start, failed)
+
+    def log_request(self, message: Message, s: str) -> None:
+        if isinstance(message.channel, DMChannel):
+            print(f"[{datetime.now(timezone.utc).isoformat()}] {s} in DM with {message.author} ({message.channel.id})")
+        elif isinstance(message.channel, GroupChannel):
+            print(f"[{datetime.now(timezone.utc).isoformat()}] {s} in group DM {f'{message.channel.name} ({message.channel.id})' if message.channel.name else message.channel.id} from {message.author}")
+        else:
+            print(f"[{datetime.now(timezone.utc).isoformat()}] {s} to #{message.channel.name} ({message.channel.id}) from {message.author}")
+
+    @command("add", args=1, required=1, usage="add https://samasaur1.github.io/feed.xml")
+    async def add_command(self, message: Message, args: List[str]) -> None:
+        url = args[0]
+        self.log_request(message, f"Request to add '{url}'")
+        if validators.url(url):
+            url = self.resolve(url)
+        if url in self.feeds:
+            if url in self.feeds_in(message.channel.id):
+                print("Already watching feed in channel")
+                await say(message, f"Already watching {url} in this channel")
             else:
-                if validators.url(url):
-                    self.feeds[url] = {message.channel.id: []}
-                    print("Now watching feed (new feed)")
-                    self.dump_feeds_to_file()
-                    await self.update_status()
-                    if url.endswith("/feed"):
-                        await say(message, f"om nom nom (now watching {url} in this channel)")
-                    else:
-                        await say(message, f"Now watching {url} in this channel")
+                self.subscribe(url, message.channel.id)
+                print("Now watching feed (existing feed)")
+                await say(message, f"Now watching {url} in this channel")
+        else:
+            if validators.url(url):
+                self.subscribe(url, message.channel.id)
+                print("Now watching feed (new feed)")
+                await self.update_status()
+                if url.endswith("/feed"):
+                    await say(message, f"om nom nom (now watching {url} in this channel)")
                 else:
-                    print("Invalid URL")
-                    await say(message, f"Not a valid URL")
-        elif cmd == "remove":
-            url = _msg[1]
-            log(f"Request to remove '{url}'")
-            if url in self.feeds and message.channel.id in self.feeds[url]:
-                del self.feeds[url][message.channel.id]
-                print("Found")
-                if len(self.feeds[url]) == 0:
-                    del self.feeds[url]
-                    print("Was last url for feed, so feed is removed")
-                    await self.update_status()
-                self.dump_feeds_to_file()
-                await say(message, f"Removed {url} from the feeds for this channel")
+                    await say(message, f"Now watching {url} in this channel")
             else:
-                await say(message, f"Could not find {url} in the feeds for this channel")
-                print("Not found")
-        elif cmd == "list":
-            log(f"Request to list feeds")
-            feeds_in_channel = []
-            for feed in self.feeds:
-                if message.channel.id in self.feeds[feed]:
-                    feeds_in_channel.append(f"{feed} (filters: {len(self.feeds[feed][message.channel.id])})")
-            if len(feeds_in_channel) == 0:
-                await say(message, "No feeds in this channel")
-                return
-            fstr = "\n".join(feeds_in_channel)
-            await say(message, f"""
+                print("Invalid URL")
+                await say(message, f"Not a valid URL")
+
+    @command("remove", args=1, required=1, usage="remove https://samasaur1.github.io/feed.xml")
+    async def remove_command(self, message: Message, args: List[str]) -> None:
+        url = args[0]
+        self.log_request(message, f"Request to remove '{url}'")
+        url = self.resolve(url)
+        if url in self.feeds_in(message.channel.id):
+            print("Found")
+            if self.unsubscribe(url, message.channel.id):
+                print("Was last url for feed, so feed is removed")
+                await self.update_status()
+            await say(message, f"Removed {url} from the feeds for this channel")
+        else:
+            await say(message, f"Could not find {url} in the feeds for this channel")
+            print("Not found")
+
+    @command("list")
+    async def list_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, f"Request to list feeds")
+        feeds_in_channel = [f"{feed} (filters: {len(self.feeds[feed][message.channel.id])})" for feed in sorted(self.feeds_in(message.channel.id))]
+        if len(feeds_in_channel) == 0:
+            await say(message, "No feeds in this channel")
+            return
+        fstr = "\n".join(feeds_in_channel)
+        await say(message, f"""
 **Feeds in this channel**:
 {fstr}
-""", 5)
-        elif cmd == "help" or cmd == "-h":
-            log(f"Request for help")
-            await say(message, """
+""")
+
+    @command("help")
+    @command("-h")
+    async def help_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, f"Request for help")
+        await say(message, """
 To add a feed, try "<@1080989856248893521> add https://samasaur1.github.io/feed.xml"
 To remove a feed, try "<@1080989856248893521> remove https://samasaur1.github.io/feed.xml"
 To list all feeds in this channel, try "<@1080989856248893521> list"
 To get help about filters, try "<@1080989856248893521> filter help"
-""", 5)
-        elif cmd == "filter":
-            if len(_msg) == 1:
-                print("filter must have subcommand")
-                await say(message, "Filter must have a subcommand (try \"<@1080989856248893521> filter help\")")
-                return
-            submsg = _msg[1].split(" ", maxsplit=2)
-            subcmd = submsg[0]
-            if subcmd == "list":
-                feed = submsg[1]
-                log(f"Request to list filters on '{feed}'")
-                if feed not in self.feeds:
-                    print("Feed not in channel")
-                    await say(message, "That feed does not exist in this channel, so it cannot have filters")
-                    return
-                if len(self.feeds[feed][message.channel.id]) == 0:
-                    await say(message, "No filters on feed in this channel")
-                    return
-                # for idx, filter in enumerate(self.feeds[feed][message.channel.id]):
-                #     output.append(f"{idx}: `{filter}`")
-                await say(message, '\n'.join([f"- `{f}`" for f in self.feeds[feed][message.channel.id]]))
-            elif subcmd == "add":
-                feed = submsg[1]
-                new_filter = submsg[2]
-                log(f"Request to add filter `{new_filter}` on '{feed}'")
-                if feed not in self.feeds:
-                    print("Feed not in channel")
-                    await say(message, "That feed does not exist in this channel, so it cannot have filters")
-                    return
-                if new_filter in self.feeds[feed][message.channel.id]:
-                    print("Filter already exists on feed in channel")
-                    await say(message, "Filter already exists on that feed in this channel")
-                else:
-                    self.feeds[feed][message.channel.id].append(new_filter)
-                    print("Filter added")
-                    self.dump_feeds_to_file()
-                    await say(message, "Filter now applies to that feed in this channel")
-            elif subcmd == "remove":
-                feed = submsg[1]
-                old_filter = submsg[2]
-                log(f"Request to remove filter `{old_filter}` on '{feed}'")
-                if feed not in self.feeds:
-                    print("Feed not in channel")
-                    await say(message, "That feed does not exist in this channel, so it cannot have filters")
-                    return
-                if old_filter in self.feeds[feed][message.channel.id]:
-                    self.feeds[feed][message.channel.id].remove(old_filter)
-                    print("Found")
-                    self.dump_feeds_to_file()
-                    await say(message, "Filter no longer applies to that feed in this channel")
-                else:
-                    print("Not found")
-                    await say(message, "No matching filter on that feed in this channel")
-            elif subcmd == "help":
-                log("Request for filter help")
-                await say(message, """
+To add many feeds at once, try "<@1080989856248893521> import" with an OPML or JSON file attached (or with URLs after it)
+To download this channel's feeds, try "<@1080989856248893521> export" (OPML) or "<@1080989856248893521> export json" (with filters)
+To post new entries with an excerpt, author, date and image, try "<@1080989856248893521> mode digest" (or "<@1080989856248893521> mode links" to go back)
+""")
+
+    @command("import", args=None)
+    async def import_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, f"Request to import {len(message.attachments)} attachments")
+        subscriptions: Dict[str, List[str]] = {}
+        try:
+            for attachment in message.attachments:
+                subscriptions.update(read_subscriptions(await attachment.read()))
+        except ValueError as err:
+            await say(message, f"Could not read that file: {err}")
+            return
+        subscriptions.update({url: [] for url in args})
+        if len(subscriptions) == 0:
+            await say(message, "Attach an OPML or JSON file (or list URLs) to import")
+            return
+        async with message.channel.typing():
+            summary = await self.import_feeds(message.channel.id, subscriptions)
+        print(summary)
+        await self.update_status()
+        await say(message, summary)
+
+    @command("export", args=1)
+    async def export_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, f"Request to export feeds")
+        feeds = sorted(self.feeds_in(message.channel.id))
+        if len(feeds) == 0:
+            await say(message, "No feeds in this channel")
+            return
+        if args and args[0].strip() == "json":
+            data = json.dumps({feed: self.feeds[feed][message.channel.id] for feed in feeds}, indent=4).encode()
+            file = File(io.BytesIO(data), filename="feeds.json")
+        else:
+            file = File(io.BytesIO(write_opml(feeds)), filename="feeds.opml")
+        await message.reply(f"{len(feeds)} feed{'s' if len(feeds) != 1 else ''} in this channel", file=file)
+
+    @command("filter", args=1)
+    async def filter_command(self, message: Message, args: List[str]) -> None:
+        """`filter` without a subcommand, or with one that doesn't exist."""
+
+        if not args:
+            print("filter must have subcommand")
+            await say(message, "Filter must have a subcommand (try \"<@1080989856248893521> filter help\")")
+        else:
+            self.log_request(message, "Unknown filter subcommand")
+            await say(message, "Unknown subcommand (try \"<@1080989856248893521> filter help\")")
+
+    async def filtered_feed(self, message: Message, url: str) -> Optional[str]:
+        """The feed a filter subcommand is about, or None (after telling the user) if it isn't in the channel."""
+
+        feed = self.resolve(url)
+        if feed not in self.feeds_in(message.channel.id):
+            print("Feed not in channel")
+            await say(message, "That feed does not exist in this channel, so it cannot have filters")
+            return None
+        return feed
+
+    @command("filter", "list", args=1, required=1, usage="filter list https://samasaur1.github.io/feed.xml")
+    async def filter_list_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, f"Request to list filters on '{args[0]}'")
+        feed = await self.filtered_feed(message, args[0])
+        if feed is None:
+            return
+        if len(self.feeds[feed][message.channel.id]) == 0:
+            await say(message, "No filters on feed in this channel")
+            return
+        # for idx, filter in enumerate(self.feeds[feed][message.channel.id]):
+        #     output.append(f"{idx}: `{filter}`")
+        await say(message, '\n'.join([f"- `{f}`" for f in self.feeds[feed][message.channel.id]]))
+
+    @command("filter", "add", args=2, required=2, usage="filter add https://samasaur1.github.io/feed.xml some filter")
+    async def filter_add_command(self, message: Message, args: List[str]) -> None:
+        new_filter = args[1]
+        self.log_request(message, f"Request to add filter `{new_filter}` on '{args[0]}'")
+        feed = await self.filtered_feed(message, args[0])
+        if feed is None:
+            return
+        if error := invalid_filter(new_filter):
+            print("Invalid filter")
+            await say(message, f"Invalid regular expression: {error}")
+        elif new_filter in self.feeds[feed][message.channel.id]:
+            print("Filter already exists on feed in channel")
+            await say(message, "Filter already exists on that feed in this channel")
+        else:
+            self.feeds[feed][message.channel.id].append(new_filter)
+            print("Filter added")
+            self.writer.save_subscription(feed, message.channel.id, self.feeds[feed][message.channel.id])
+            await say(message, "Filter now applies to that feed in this channel")
+
+    @command("filter", "remove", args=2, required=2, usage="filter remove https://samasaur1.github.io/feed.xml some filter")
+    async def filter_remove_command(self, message: Message, args: List[str]) -> None:
+        old_filter = args[1]
+        self.log_request(message, f"Request to remove filter `{old_filter}` on '{args[0]}'")
+        feed = await self.filtered_feed(message, args[0])
+        if feed is None:
+            return
+        if old_filter in self.feeds[feed][message.channel.id]:
+            self.feeds[feed][message.channel.id].remove(old_filter)
+            print("Found")
+            self.writer.save_subscription(feed, message.channel.id, self.feeds[feed][message.channel.id])
+            await say(message, "Filter no longer applies to that feed in this channel")
+        else:
+            print("Not found")
+            await say(message, "No matching filter on that feed in this channel")
+
+    @command("filter", "help")
+    async def filter_help_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, "Request for filter help")
+        await say(message, """
 **Filters** are strings, configurable per feed by channel. If a new post matches any of the existing filters, the post will not be posted in that channel.
+A filter starting with `re:` is a regular expression (like `re:^Sponsored`), and one starting with `re:(?i)` is a case-insensitive one (no other flags, named groups or backreferences).
 To list filters on a feed (in the current channel), try "<@1080989856248893521> filter list https://samasaur1.github.io/feed.xml".
 To add a filter on a feed, try "<@1080989856248893521> filter add https://samasaur1.github.io/feed.xml some multi-word filter I don't want to see posts about" (no quotes are required)
 To add a filter on a feed, try "<@1080989856248893521> filter remove https://samasaur1.github.io/feed.xml some filter I once added, but now want to see posts about again" (no quotes are required)
-""", 5)
+""")
+
+    @command("mode", args=1)
+    async def mode_command(self, message: Message, args: List[str]) -> None:
+        mode = args[0].strip() if args else ""
+        self.log_request(message, f"Request to set mode '{mode}'")
+        current = self.channel_modes.get(message.channel.id, "links")
+        if mode == "":
+            await say(message, f"This channel is in {current} mode (try \"<@1080989856248893521> mode digest\" or \"<@1080989856248893521> mode links\")")
+        elif mode not in ("links", "digest"):
+            await say(message, f"Unknown mode {mode} (try digest or links)")
+        elif mode == current:
+            await say(message, f"This channel is already in {mode} mode")
+        else:
+            if mode == "links":
+                del self.channel_modes[message.channel.id]
+                self.writer.save_channel_mode(message.channel.id, None)
             else:
-                log("Unknown filter subcommand")
-                await say(message, "Unknown subcommand (try \"<@1080989856248893521> filter help\")")
-        elif cmd == "oob":
-            log(f"Request to oob")
-            await say(message, "<@937855314290692187>") #@oobot
-        elif cmd == "censor":
-            log("Request to add global filter")
-            if message.author.id != self.ADMIN_UID:
-                await say(message, "Unauthorized user")
-                return
-            self.global_filters.append(_msg[1])
-            await say(message, "Censored all posts matching filter")
-        elif cmd == "uncensor":
-            log("Request to remove global filter")
-            if message.author.id != self.ADMIN_UID:
-                await say(message, "Unauthorized user")
-                return
-            self.global_filters.remove(_msg[1])
-            await say(message, "Uncensored all posts matching filter")
-        elif cmd == "censorship":
-            log("Request to list global filters")
-            if message.author.id != self.ADMIN_UID:
-                await say(message, "Unauthorized user")
-                return
-            await say(message, ', '.join([f"`{x}`" for x in self.global_filters]))
-        elif cmd == "status":
-            log(f"Request for status")
-            if message.author.id != self.ADMIN_UID:
-                await say(message, "Unauthorized user")
-                return
-            td = datetime.now(timezone.utc) - self.last_check
-
-            def desc(id: int):
-                # This should work, but it doesn't for some reason
-                # chan = self.get_channel(id)
-                # if isinstance(chan, DMChannel):
-                #     return f"DM with {chan.recipient}"
-                # elif isinstance(chan, GroupChannel):
-                #     return f"Group DM{f' named {chan.name}' if chan.name else ''} with [{', '.joined(map(lambda user: user.name, chan.recipients))}]"
-                # else:
-                #     return f"#{chan.name} in {chan.guild.name}"
-                return f"<#{id}>"
-            s = f"""
+                self.channel_modes[message.channel.id] = mode
+                self.writer.save_channel_mode(message.channel.id, mode)
+            await say(message, f"New posts in this channel will now be shown as {'embeds with an excerpt' if mode == 'digest' else 'links'}")
+
+    @command("oob")
+    async def oob_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, f"Request to oob")
+        await say(message, "<@937855314290692187>") #@oobot
+
+    @command("censor", args=1, required=1, usage="censor some filter", admin=True)
+    async def censor_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, "Request to add global filter")
+        if error := invalid_filter(args[0]):
+            await say(message, f"Invalid regular expression: {error}")
+            return
+        self.global_filters.append(args[0])
+        self.writer.save_global_filters(self.global_filters)
+        await say(message, "Censored all posts matching filter")
+
+    @command("uncensor", args=1, required=1, usage="uncensor some filter", admin=True)
+    async def uncensor_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, "Request to remove global filter")
+        self.global_filters.remove(args[0])
+        self.writer.save_global_filters(self.global_filters)
+        await say(message, "Uncensored all posts matching filter")
+
+    @command("censorship", admin=True)
+    async def censorship_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, "Request to list global filters")
+        await say(message, ', '.join([f"`{x}`" for x in self.global_filters]))
+
+    @command("status", admin=True)
+    async def status_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, f"Request for status")
+        td = datetime.now(timezone.utc) - self.last_check
+
+        def desc(id: int):
+            # This should work, but it doesn't for some reason
+            # chan = self.get_channel(id)
+            # if isinstance(chan, DMChannel):
+            #     return f"DM with {chan.recipient}"
+            # elif isinstance(chan, GroupChannel):
+            #     return f"Group DM{f' named {chan.name}' if chan.name else ''} with [{', '.joined(map(lambda user: user.name, chan.recipients))}]"
+            # else:
+            #     return f"#{chan.name} in {chan.guild.name}"
+            return f"<#{id}>"
+
+        def next_check(feed: str, details: bool = False):
+            # Only what's already in memory: loading every feed's state just to list them would defeat LazyFeedData
+            data = self.feed_data.peek(feed)
+            if data is None:
+                due = self.feed_data.next_due(feed)
+                return f"- {feed}: pending first check" if due is None else f"- {feed}: <t:{int(due)}:R>"
+            if data.failures and not details:
+                return f"- {feed}: <t:{int(data.next_due)}:R> (failing)"
+            if data.failures:
+                state = "retried daily" if data.circuit_open else "backing off"
+                return f"- {feed}: <t:{int(data.next_due)}:R> (failed {data.failures} times since <t:{int(data.failing_since)}:R>, {state}: {data.last_error})"
+            return f"- {feed}: <t:{int(data.next_due)}:R> (every {timedelta(seconds=round(data.interval))}{', pushed by its hub' if data.pushed else ''})"
+        # One line per feed doesn't fit in a message for long, so only the next few due and the failing ones
+        by_due = sorted(self.feeds, key=lambda f: self.feed_data.next_due(f) or 0)
+        failing = [feed for feed in by_due if (data := self.feed_data.peek(feed)) and data.failures]
+        schedule = "\n".join(next_check(feed) for feed in by_due[:STATUS_FEEDS])
+        if len(by_due) > STATUS_FEEDS:
+            schedule += f"\n…and {len(by_due) - STATUS_FEEDS} more"
+        if failing:
+            schedule += f"\nFailing ({len(failing)}):\n" + "\n".join(next_check(feed, details=True) for feed in failing[:STATUS_FEEDS])
+            if len(failing) > STATUS_FEEDS:
+                schedule += f"\n…and {len(failing) - STATUS_FEEDS} more"
+        channels = ", ".join(desc(channel) for channel in list(self.channels)[:STATUS_FEEDS])
+        if len(self.channels) > STATUS_FEEDS:
+            channels += f" and {len(self.channels) - STATUS_FEEDS} more"
+        s = f"""
 **Status:**
 Time since last check: {td}
-Estimated time until next check (approximate): {timedelta(seconds=RSS_FETCH_INTERVAL - td.total_seconds())}
-Feeds being watched: {list(self.feeds.keys())}
-Channels with feeds: {', '.join({desc(channel) for channels in self.feeds.values() for channel in channels})}
+Channels with feeds ({len(self.channels)}): {channels}
+{self.metrics.summary()}
+Feeds being watched: {len(self.feeds)} (next checks):
+{schedule}
 """
-            await say(message, s, 1)
-        elif cmd == "forcerefresh":
-            log(f"Request to forcerefresh")
-            if message.author.id != self.ADMIN_UID:
-                await say(message, "Unauthorized user")
-                return
-            self.schedule_updates()
-        elif cmd == "prune":
-            log("Request to prune")
-            if message.author.id != self.ADMIN_UID:
-                await say(message, "Unauthorized user")
+        if len(s) > MESSAGE_LIMIT:
+            s = s[:MESSAGE_LIMIT - 1] + "…"
+        await say(message, s)
+
+    @command("forcerefresh", args=1, admin=True)
+    async def forcerefresh_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, f"Request to forcerefresh")
+        if args:
+            feed = self.resolve(args[0].strip())
+            if feed not in self.feeds:
+                await say(message, f"Not watching {feed}")
                 return
-            pruned_channels = set()
-            pruned_feeds = set()
-            needs_status_update = False
+            self.schedule(feed, 0.0)
+            await say(message, f"Refreshing {feed}")
+        else:
             for feed in self.feeds:
-                for channel_id in self.feeds[feed]:
-                    if self.get_channel(channel_id) is None:
-                        pruned_channels.add(channel_id)
-                for channel in pruned_channels:
-                    del self.feeds[feed][channel]
-                if len(self.feeds[feed]) == 0:
+                self.schedule(feed, 0.0)
+            await say(message, f"Refreshing {len(self.feeds)} feeds")
+
+    @command("prune", admin=True)
+    async def prune_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, "Request to prune")
+        pruned_channels = {channel_id for channel_id in self.channels if self.get_channel(channel_id) is None}
+        pruned_feeds = set()
+        for channel_id in pruned_channels:
+            for feed in list(self.channels[channel_id]):
+                if self.unsubscribe(feed, channel_id):
                     pruned_feeds.add(feed)
-                    needs_status_update = True
-            for feed in pruned_feeds:
-                del self.feeds[feed]
-            verbose(f"Pruned [{', '.join((str(x) for x in pruned_channels))}]")
-            if needs_status_update:
-                verbose(f"...which pruned [{', '.join(pruned_feeds)}]")
-                await self.update_status()
-            pc = f"{len(pruned_channels)} channel{'s' if len(pruned_channels) != 1 else ''}"
-            pf = f", {len(pruned_feeds)} feed{'s' if len(pruned_feeds) != 1 else ''}" if needs_status_update else ""
-            await say(message, f"Pruned {pc}{pf}")
-        elif cmd == "reactwith":
-            log("Request to add reaction to message")
-            if message.author.id != self.ADMIN_UID:
-                await say(message, "Unauthorized user")
-                return
-            print(msg)
-            args = [x for x in _msg[1].split(" ") if x != ""]
-            if len(args) < 2:
-                await say(message, "Missing arguments")
-                return
+        orphans = self.collect_garbage()
+        if orphans:
+            verbose(f"Dropped the state of {orphans} feeds no longer watched")
+        needs_status_update = len(pruned_feeds) > 0
+        verbose(f"Pruned [{', '.join((str(x) for x in pruned_channels))}]")
+        if needs_status_update:
+            verbose(f"...which pruned [{', '.join(pruned_feeds)}]")
+            await self.update_status()
+        pc = f"{len(pruned_channels)} channel{'s' if len(pruned_channels) != 1 else ''}"
+        pf = f", {len(pruned_feeds)} feed{'s' if len(pruned_feeds) != 1 else ''}" if needs_status_update else ""
+        await say(message, f"Pruned {pc}{pf}")
 
-            if len(args) == 2:
-                chan = message.channel
-            else: #len(args) == 3:
-                chan = self.get_channel(int(args[2]))
-            verbose(f"Got channel {chan} with name {chan.name if chan.name else '{}'}")
+    @command("reactwith", args=None, required=2, usage="reactwith emoji message_id [channel_id]", admin=True)
+    async def reactwith_command(self, message: Message, args: List[str]) -> None:
+        self.log_request(message, "Request to add reaction to message")
+        print(args)
+        if len(args) == 2:
+            chan = message.channel
+        else: #len(args) == 3:
+            chan = self.get_channel(int(args[2]))
+        verbose(f"Got channel {chan} with name {chan.name if chan.name else '{}'}")
 
-            if args[0].startswith("<:") and args[0].endswith(">"):
-                react_emoji = args[0]
-            elif all(ord(c) < 128 for c in args[0]):
-                react_emoji = discord.utils.get(chan.guild.emojis, name=args[0])
+        if args[0].startswith("<:") and args[0].endswith(">"):
+            react_emoji = args[0]
+        elif all(ord(c) < 128 for c in args[0]):
+            react_emoji = discord.utils.get(chan.guild.emojis, name=args[0])
+        else:
+            react_emoji = args[0]
+        verbose(f"Got emoji {react_emoji} with name {args[0]}")
+        react_message = await chan.fetch_message(int(args[1]))
+        verbose(f"Got message {react_message} with id {args[1]}")
+        await react_message.add_reaction(react_emoji)
+
+    @command("sudo")
+    async def sudo_command(self, message: Message, args: List[str]) -> None:
+        if message.author.id == self.ADMIN_UID:
+            return
+        await say(message, f"'{message.author}' is not in the sudoers file. This incident will be reported.")
+
+    async def unknown_command(self, message: Message, cmd: str) -> None:
+        if message.author.id == 268838716259172374:
+            if cmd.startswith("hi") or cmd == "hello" or cmd == "hey":
+                await say(message, "hi alex!")
+                return
+            elif cmd == "ily":
+                await say(message, "ily too!")
+                return
             else:
-                react_emoji = args[0]
-            verbose(f"Got emoji {react_emoji} with name {args[0]}")
-            react_message = await chan.fetch_message(int(args[1]))
-            verbose(f"Got message {react_message} with id {args[1]}")
-            await react_message.add_reaction(react_emoji)
-        elif cmd == "sudo":
-            if message.author.id == self.ADMIN_UID:
+                await say(message, "sorry, bestie, i don't understand")
                 return
-            await say(message, f"'{message.author}' is not in the sudoers file. This incident will be reported.")
+        self.log_request(message, f"Unknown command")
+        await say(message, "Unknown command (try \"<@1080989856248893521> help\")")
+
+    async def check_aliases(self, feeds: List[str]) -> List[Optional[List[Entry]]]:
+        """Check a group of feeds that live at the same URL (usually just one feed), in a worker process if sharded."""
+
+        new = [feed not in self.feed_data for feed in feeds]
+        for feed in feeds:
+            if feed not in self.feed_data:
+                self.feed_data[feed] = FeedData(feed)
+        datas = [self.feed_data[feed] for feed in feeds]
+        new = [is_new or not data.primed for is_new, data in zip(new, datas)]
+        if not self.shards:
+            return await check_group(datas, new, self.fetcher)
+
+        try:
+            datas, results, stats = await self.shards.check(datas, new)
+        except BaseException:
+            # Don't leave new feeds looking as if they'd been checked (and had no entries)
+            for feed, is_new in zip(feeds, new):
+                if is_new:
+                    self.feed_data.pop(feed, None)
+            raise
+        for data in datas:
+            if data.url in self.feeds:
+                self.feed_data[data.url] = data
+        self.metrics.feeds.update(stats)
+        return results
+
+    async def check_feeds(self, feeds: List[str]) -> None:
+        """Fetch the given feeds concurrently, then plan (see plan_deliveries) and queue their new entries' delivery.
+
+        Feeds that fail are backed off (see FeedData.failed) rather than reported every time; the debug channel gets
+        one message per check about the feeds that started failing, stopped being retried, or recovered.
+        """
+
+        failures = {feed: self.feed_data[feed].failures if feed in self.feed_data else 0 for feed in feeds}
+        groups: Dict[str, List[str]] = {}
+        for feed in feeds:
+            groups.setdefault(feed_key(self.feed_data.href(feed) or feed), []).append(feed)
+        # Feeds we've fetched before go first, since the group's first feed is the one that does the fetching
+        for group in groups.values():
+            group.sort(key=lambda f: f not in self.feed_data or not self.feed_data[f].primed)
+        self.checking.update(feeds)
+        try:
+            group_results = await gather(*(self.check_aliases(group) for group in groups.values()), return_exceptions=True)
+        finally:
+            self.checking.difference_update(feeds)
+        feeds, results = [], []
+        for group, group_result in zip(groups.values(), group_results):
+            feeds.extend(group)
+            results.extend(group_result if isinstance(group_result, list) else [group_result] * len(group))
+        for feed in feeds:
+            if feed in self.feed_data and self.feed_data[feed].href:
+                self.add_aliases(feed)
+        renamed = self.merge_redirects(feeds)
+        planned: Dict[str, Set[str]] = {} # { feed -> keys of entries planned }, when feeds were merged
+
+        failing, broken, recovered, errors = [], [], [], []
+        plan: Dict[int, List[Delivery]] = {} # { channel -> what to send it }
+        for feed, original_entries in zip(feeds, results):
+            verbose(f"...{feed}")
+            data = self.feed_data.get(feed)
+            if isinstance(original_entries, BaseException):
+                print(f"Unexpected {original_entries=}, {type(original_entries)=}")
+                errors.append(f"{feed}: {original_entries!r}")
+                if data:
+                    data.failed(describe_error(original_entries))
+            if data and data.failures >= FAILURES_TO_REPORT > failures[feed]:
+                failing.append(feed)
+            if data and data.failures >= CIRCUIT_THRESHOLD > failures[feed]:
+                broken.append(feed)
+            if data and data.failures == 0 and failures[feed] >= FAILURES_TO_REPORT:
+                recovered.append(feed)
+            if original_entries is None or isinstance(original_entries, BaseException):
+                continue
+            if renamed:
+                # The same feed may have been checked under two URLs, so don't plan an entry twice
+                while feed in renamed:
+                    feed = renamed[feed]
+                keys = planned.setdefault(feed, set())
+                original_entries = [entry for entry in original_entries if entry.key() not in keys]
+                keys.update(entry.key() for entry in original_entries)
+            try:
+                for channel_id, delivery in self.plan_feed(feed, original_entries).items():
+                    plan.setdefault(channel_id, []).append(delivery)
+            except Exception as err:
+                print(f"Unexpected {err=}, {type(err)=}")
+                errors.append(f"{feed}: {err!r}")
+        for channel_id, deliveries in plan.items():
+            self.delivery.put(channel_id, deliveries)
+        await self.report_health(failing, broken, recovered, errors)
+        if WEBSUB_URL:
+            for feed in feeds:
+                data = self.feed_data.get(feed)
+                if data and data.hub and feed in self.feeds and self.websub_due(data):
+                    self.background(self.websub_request(data, "subscribe"))
+
+    def plan_feed(self, feed: str, original_entries: List[Entry]) -> Dict[int, Delivery]:
+        verbose(f"{len(original_entries)} entries")
+        entries = [entry for entry in original_entries if not censored_by(entry, self.global_filters)]
+        verbose(f"{len(entries)} entries (post-censorship)")
+        if len(entries) == 0:
+            return {}
+        for entry in entries:
+            print(f"New post on {feed}: {entry.output()}")
+        return plan_deliveries(feed, entries, self.feeds.get(feed, {}))
+
+    def background(self, coroutine) -> None:
+        task = create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    @staticmethod
+    def websub_due(data: FeedData) -> bool:
+        """Whether to ask the feed's hub for a (renewed) subscription: ours runs out within a day, and we haven't
+        asked in the last hour."""
+
+        now = time.time()
+        if data.push_expires and data.push_expires - now > 24 * 60 * 60:
+            return False
+        return not data.push_requested or now - data.push_requested > 60 * 60
+
+    async def websub_request(self, data: FeedData, mode: str) -> None:
+        """Ask the feed's hub to (un)subscribe us. The hub then confirms with a GET to our callback (verify_push)."""
+
+        self.push_callbacks[websub_id(data.url)] = data.url
+        data.push_token = data.push_token or secrets.token_urlsafe(16)
+        callback = f"{websub_id(data.url)}/{data.push_token}"
+        topic = data.topic or data.href or data.url
+        form = {"hub.mode": mode, "hub.topic": topic, "hub.callback": f"{WEBSUB_URL}/websub/{callback}"}
+        if mode == "subscribe":
+            data.push_secret = data.push_secret or secrets.token_hex(20)
+            data.push_requested = time.time()
+            form.update({"hub.secret": data.push_secret, "hub.lease_seconds": str(WEBSUB_LEASE)})
         else:
-            if message.author.id == 268838716259172374:
-                if cmd.startswith("hi") or cmd == "hello" or cmd == "hey":
-                    await say(message, "hi alex!")
-                    return
-                elif cmd == "ily":
-                    await say(message, "ily too!")
-                    return
-                else:
-                    await say(message, "sorry, bestie, i don't understand")
-                    return
-            log(f"Unknown command")
-            await say(message, "Unknown command (try \"<@1080989856248893521> help\")")
+            self.push_unsubscribing[callback] = topic
+        verbose(f"WebSub {mode} request for {data.url} to {data.hub}")
+        try:
+            async with self.fetcher.session.post(data.hub, data=form) as response:
+                if response.status >= 300:
+                    print(f"ERR: WebSub hub {data.hub} refused to {mode} {data.url}: status {response.status}")
+        except Exception as err:
+            print(f"ERR: WebSub hub {data.hub} errored on {mode} {data.url}: {err!r}")
+
+    def websub_data(self, request: web.Request) -> Optional[FeedData]:
+        """The watched feed a callback URL belongs to, if its token is right."""
+
+        feed_id, token = request.match_info["feed_id"], request.match_info["token"]
+        feed = self.push_callbacks.get(feed_id)
+        if feed is None:
+            # Subscriptions from before a restart
+            self.push_callbacks.update((websub_id(feed), feed) for feed in self.feeds)
+            feed = self.push_callbacks.get(feed_id)
+        data = self.feed_data.get(feed) if feed in self.feeds else None
+        if data is None or not data.push_token or not hmac.compare_digest(data.push_token, token):
+            return None
+        return data
+
+    async def verify_push(self, request: web.Request) -> web.Response:
+        """The hub checking that we asked for a subscription (or unsubscription), or telling us it refused one."""
+
+        mode = request.query.get("hub.mode")
+        topic = request.query.get("hub.topic")
+        challenge = request.query.get("hub.challenge", "")
+        if mode == "unsubscribe":
+            callback = f"{request.match_info['feed_id']}/{request.match_info['token']}"
+            if topic is None or self.push_unsubscribing.get(callback) != topic:
+                return web.Response(status=404)
+            del self.push_unsubscribing[callback]
+            return web.Response(text=challenge)
+
+        data = self.websub_data(request)
+        if data is None or topic != (data.topic or data.href or data.url):
+            return web.Response(status=404)
+        feed = data.url
+        if mode == "subscribe":
+            # Only confirm a subscription we asked for within the last hour
+            if not data.push_secret or not data.push_requested or time.time() - data.push_requested > 60 * 60:
+                return web.Response(status=404)
+            try:
+                lease = min(float(request.query.get("hub.lease_seconds", WEBSUB_LEASE)), WEBSUB_LEASE)
+            except ValueError:
+                lease = WEBSUB_LEASE
+            if not lease > 0:
+                return web.Response(status=404)
+            data.push_expires = time.time() + lease
+            self.writer.save_feed_data(data)
+            print(f"Receiving pushes for {feed} from {data.hub} for {timedelta(seconds=round(lease))}")
+            return web.Response(text=challenge)
+        if mode == "denied":
+            print(f"ERR: WebSub hub {data.hub} denied subscription to {feed}: {request.query.get('hub.reason')}")
+            data.push_expires = None
+            self.writer.save_feed_data(data)
+            return web.Response()
+        return web.Response(status=404)
+
+    async def receive_push(self, request: web.Request) -> web.Response:
+        """New content from a hub, which goes through the same diff (FeedData.update) as a polled copy of the feed."""
+
+        data = self.websub_data(request)
+        if data is None or not data.push_secret:
+            return web.Response(status=410) # the hub should stop sending these
+        feed = data.url
+        body = await request.read()
+        method, _, signature = request.headers.get("X-Hub-Signature", "").partition("=")
+        if method not in ("sha1", "sha256", "sha384", "sha512") or not hmac.compare_digest(hmac.new(data.push_secret.encode(), body, method).hexdigest(), signature):
+            # Acknowledged, as the spec requires, but ignored
+            print(f"ERR: WebSub push for {feed} has a bad signature")
+            self.metrics.count("rssbot_websub_rejected_total")
+            return web.Response(status=202)
+        self.metrics.count("rssbot_websub_pushes_total")
+        if feed in self.checking:
+            # Being polled right now (maybe in a worker process, with its own copy of the state): just poll again
+            self.schedule(feed, 0.0)
+            return web.Response(status=202)
+
+        try:
+            d = await self.fetcher.parse(feed, FetchResult(200, data.topic or feed, CIMultiDict({"Content-Type": request.content_type}), body))
+        except Exception as err:
+            print(f"ERR: WebSub push for {feed} could not be parsed: {err!r}")
+            return web.Response(status=202)
+        # The feed may have been removed, or its state unloaded and loaded again, while the push was parsed
+        data = self.feed_data.get(feed) if feed in self.feeds else None
+        if data is None:
+            return web.Response(status=202)
+        parsed = ParsedFeed(200, data.href or feed, CIMultiDict(), d.feed, d.entries)
+        hub, topic = data.hub, data.topic
+        entries = data.update(parsed, self.metrics)
+        # The push has no headers, and may leave out the feed's own hub links; they haven't changed
+        data.hub, data.topic = hub, topic
+        if entries:
+            for channel_id, delivery in self.plan_feed(feed, entries).items():
+                self.delivery.put(channel_id, [delivery])
+        self.schedule(feed)
+        self.writer.save_feed_data(data)
+        return web.Response(status=202)
+
+    async def report_health(self, failing: List[str], broken: List[str], recovered: List[str], errors: List[str]) -> None:
+        def describe(feed: str):
+            data = self.feed_data.get(feed)
+            return f"- {feed} ({data.last_error})" if data and data.last_error else f"- {feed}"
+
+        sections = []
+        if failing:
+            sections.append(f"Error! {len(failing)} feed{'s' if len(failing) != 1 else ''} failed {FAILURES_TO_REPORT} times in a row:\n" + "\n".join(map(describe, failing)))
+        if broken:
+            sections.append(f"{len(broken)} feed{'s' if len(broken) != 1 else ''} failed {CIRCUIT_THRESHOLD} times in a row, and will only be retried daily:\n" + "\n".join(map(describe, broken)))
+        if recovered:
+            sections.append(f"{len(recovered)} feed{'s' if len(recovered) != 1 else ''} working again:\n" + "\n".join(map(describe, recovered)))
+        if errors:
+            sections.append("Unexpected errors:\n" + "\n".join(f"- {error}" for error in errors))
+        if not sections:
+            return
+        msg = "\n".join(sections)
+        if len(msg) > MESSAGE_LIMIT:
+            msg = msg[:MESSAGE_LIMIT - 1] + "…"
+        try:
+            await self.notify(msg)
+        except Exception as err:
+            print(f"ERR: Cannot notify debug channel: {err!r}")
+
+    def schedule(self, feed: str, due: Optional[float] = None) -> None:
+        """Queue a feed to be checked at `due` (by default, when its data says it's next due, or now if it has none).
+
+        This replaces any time the feed was already queued for, and wakes the update task if it's asleep.
+        """
+
+        if due is None:
+            due = self.feed_data.next_due(feed) or 0.0
+        self.scheduled[feed] = due
+        heapq.heappush(self.queue, (due, feed))
+        self.wake.set()
 
     def schedule_updates(self) -> None:
+        """Start the update task, which polls each feed whenever it falls due, unless it's already running.
+
+        `self.queue` is a heap of (time, feed), and `self.scheduled` holds the time each feed is actually queued for;
+        entries in the heap that don't match it are stale (the feed was rescheduled or removed) and are skipped.
+        Feeds that are due when the task starts are spread out over the first RSS_FETCH_INTERVAL.
+        """
+
         async def task():
-            # await sleep(15)
+            while True:
+                now = time.time()
+                due = []
+                while self.queue and self.queue[0][0] <= now:
+                    when, feed = heapq.heappop(self.queue)
+                    if feed in self.feeds and self.scheduled.get(feed) == when:
+                        del self.scheduled[feed]
+                        due.append(feed)
 
-            verbose("Checking feeds...")
-            for feed in self.feeds:
-                verbose(f"...{feed}")
+                if due:
+                    verbose(f"Checking {len(due)} feeds...")
+                    self.last_check = datetime.now(timezone.utc)
+                    start = time.perf_counter()
+                    try:
+                        await self.check_feeds(due)
+                    except Exception as err:
+                        print(f"Unexpected {err=}, {type(err)=} checking feeds")
+                    self.metrics.cycle(time.perf_counter() - start, len(due))
+                    if METRICS_FILE:
+                        try:
+                            self.metrics.write(METRICS_FILE)
+                        except OSError as err:
+                            print(f"ERR: Cannot write metrics to {METRICS_FILE}: {err!r}")
+                    for feed in due:
+                        # A feed that was refreshed while being checked is already queued again
+                        if feed in self.feeds and feed not in self.scheduled:
+                            self.schedule(feed, self.feed_data[feed].next_due if feed in self.feed_data else time.time() + RSS_FETCH_INTERVAL)
+                    self.save_feed_state(due)
+
+                self.wake.clear()
+                if self.queue and self.queue[0][0] <= time.time():
+                    continue
+                wait = self.queue[0][0] - time.time() if self.queue else RSS_FETCH_INTERVAL
                 try:
-                    if feed not in self.feed_data:
-                        verbose("(first time checking; marking all posts as read)")
-                        self.feed_data[feed] = FeedData(feed)
-                        self.feed_data[feed].new_entries()
-                        # Assume that newly-added blogs have had all their posts read already
-                    original_entries = self.feed_data[feed].new_entries()
-                    if original_entries is None:
-                        await self.notify(f"Error! Feed {feed} could not be reached!")
-                        continue
-                    verbose(f"{len(original_entries)} entries")
-                    entries = [entry for entry in original_entries if not censored_by(entry, self.global_filters)]
-                    verbose(f"{len(entries)} entries (post-censorship)")
-                    if len(entries) == 0:
-                        continue
-                    for entry in entries:
-                        print(f"New post on {feed}: {entry.output()}")
-
-                    for channel_id in self.feeds[feed]:
-                        filters = self.feeds[feed][channel_id]
-                        chan_entries = [entry for entry in entries if not censored_by(entry, filters)]
-                        if len(chan_entries) == 0:
-                            verbose(f"All entries in channel {channel_id} censored")
-                            continue
-                        channel = self.get_channel(channel_id)
-                        if not channel:
-                            # Consider automatically removing this channel?
-                            print(f"ERR: Cannot get channel <#{channel_id}> to update {feed}")
-                            await self.notify(f"Error! Cannot get channel <#{channel_id}> to update {feed}")
-                            continue
-                        async with channel.typing():
-                            await sleep(randrange(1, 3))
-                            for entry in chan_entries:
-                                await channel.send(f"New post from {feed}:\n{entry.output()}")
-                except Exception as err:
-                    print(f"Unexpected {err=}, {type(err)=}")
-                    await self.notify(f"Unexpected {err=}, {type(err)=}")
-                    raise
-
-            self.dump_feeds_to_file()
-            await sleep(RSS_FETCH_INTERVAL)
-            # await sleep(45) #45 seconds
-
-            self.schedule_updates()
-
-            # While unlikely, it is possible that schedule_oob() could be called
-            # while the current task is in the middle of running oob() (since
-            # it has a small delay to simulate typing). Running oob() in a new
-            # task should prevent this.
-            # create_task(self.oob(channel, None))
-
-            # Reset the delay to the maximum and start a new delay task.
-            # Restarting the task ensures that the bot will eventually send an
-            # oob again even if no one else sends one.
-            # self.scheduled_oobs[channel_id]["delay_secs"] = self.DELAY_MAX
-            # self.schedule_oob(channel_id)
-
-        if self.task:
-            verbose("Canceling task")
-            self.task.cancel()
+                    await wait_for(self.wake.wait(), min(max(wait, 1), RSS_FETCH_INTERVAL))
+                except TimeoutError:
+                    pass
 
-        delay_task = create_task(task(), name="rssbot.update")
-        self.task = delay_task
-        self.last_check = datetime.now(timezone.utc)
+        if self.task and not self.task.done():
+            return
+
+        # Spread out feeds that are already due (every feed, the first time, or after downtime) over one polling
+        # interval, most overdue first, rather than fetching them all at once
+        now = time.time()
+        backlog = sorted((self.feed_data.next_due(feed) or 0.0, feed) for feed in self.feeds if feed not in self.scheduled)
+        overdue = [feed for due, feed in backlog if due <= now]
+        for i, feed in enumerate(overdue):
+            self.schedule(feed, now + i * RSS_FETCH_INTERVAL / len(overdue))
+        for due, feed in backlog:
+            if due > now:
+                self.schedule(feed, due)
+
+        self.task = create_task(task(), name="rssbot.update")
 
 
 if __name__ == "__main__":
@@ -584,28 +2864,9 @@ if __name__ == "__main__":
     print(f"...verbose={'VERBOSE' in environ.keys()}")
     print(f"...debug channel={os.getenv('DEBUG_CHANNEL', '1080991601502986331 (default)')}")
     print(f"...admin UID={os.getenv('ADMIN_UID', '377776843425841153 (default)')}")
-    print("searching for feed files in working directory")
-    try:
-        with open("feeds.json", "r") as file:
-            feeds = json.load(file)
-            print("...loaded feeds")
-    except:
-        print("...feeds not found")
-        feeds = {}
-    try:
-        with open("feeddata.json", "r") as file:
-            feed_data = json.load(file)
-            print("...loaded feed data")
-    except:
-        print("...feed data not found")
-        feed_data = {}
-    try:
-        with open("filters.json", "r") as file:
-            filters = json.load(file)
-            print("...loaded global filters")
-    except:
-        print("...global filters not found")
-        filters = []
-    feed_data = {feed: FeedData.from_dict(**feed_data[feed]) for feed in feed_data.keys()}
+    state_db = os.getenv('STATE_DB', 'rssbot.db')
+    print(f"...state database={state_db}")
+    store = StateStore(state_db)
+    feeds, feed_data, filters = store.load()
     print("connecting to Discord...")
-    RssBot(feeds, feed_data, filters).run(token)
+    RssBot(feeds, feed_data, filters, store).run(token)